@@ -1,28 +1,102 @@
 #! python3
 from pprint import pprint
-from os.path import getsize
+import sys
+from os import replace
+from os.path import exists, getsize
 from collections import deque
 from itertools import count
 from logging import exception
-from time import gmtime
-import iotools
+from time import gmtime, monotonic
+import pickle
+import dvbtext
+import epg
+import sinks
+import stats
 import tstools
 
 PFMT = ("\033[46m[%04d]\033[0m\033[36m(%02d)\033[0m %d|%d|%d "
         "%d <\033[92m%.3f%%\033[0m>")
 RFMT = "\033[1m\033[91m%s\033[0m"
 GFMT = "\033[1;32m%s\033[0m"
-PES_WITH_EXTENSION = set([0xBD])
-PES_WITH_EXTENSION.update(range(0xC0, 0xDF + 1))
-PES_WITH_EXTENSION.update(range(0xE0, 0xEF + 1))
 EIT_ACTUAL = set([0x4E])
 EIT_ACTUAL.update(range(0x50, 0x5F + 1))
+PIDS = 1 << 13
+CHECKPOINT_INTERVAL = 30  # Seconds between checkpoints
+CHECKPOINT_VERSION = 5  # 5: counters + 16 after no payload
+# State of a Stream saved in its checkpoints, with the PSI cache
+CHECKPOINT = ("index", "td", "pat", "pes", "timing", "sections", "pmt", "pcr",
+              "sdt", "eit", "counters", "programs", "states", "stats", "sync",
+              "skipPids", "skip")
+# Header bytes decoded once for every value
+PID_HIGH = [(b & 0x1F) << 8 for b in range(256)]
+BYTE1 = [((b & 0x80) >> 7, (b & 0x40) >> 6, (b & 0x20) >> 5)
+         for b in range(256)]  # tei, pusi, priority
+BYTE3 = [((b & 0xC0) >> 6, b & 0x20, b & 0x10, b & 0x0F)
+         for b in range(256)]  # tsc, adaptation, payload, counter
+# Kind of event -> (console format, names of the fields)
+EVENTS = {
+    "packet": (PFMT, ("pid", "counter", "tei", "pusi", "priority", "tsc",
+                      "progress")),
+    "tei": (RFMT % "\033[7Transport Error Indicator (TEI)\033[0", ()),
+    "newPid": (GFMT % "First time we receive this PID", ()),
+    "discontinuity": (RFMT % "Counter discontinuity, from %d to %d",
+                      ("last", "counter")),
+    "adaptation": ("   ADAPTATION (%03d) %d|%d|%d|%d|%d|%d|%d|%d",
+                   ("length", "discontinuity", "rai", "streamPriority",
+                    "pcrF", "opcrF", "splice", "private", "extension")),
+    "pcr": ("   PCR -> %d", ("pcr",)),
+    "opcr": ("   OPCR -> %d", ("opcr",)),
+    "pes": ("   PES[%d] (0x%02X) %d bytes, PTS %s DTS %s",
+            ("pid", "streamId", "size", "pts", "dts")),
+    "mip": ("\n\n\n\n\n" + RFMT % "DVB-MIP is not implemented", ()),
+    "incomplete": (RFMT % "Incomplete data does not match previous PID", ()),
+    "psi": ("   PSI[%03d] (%d) %d|%d",
+            ("tableId", "length", "syntax", "private")),
+    "newTable": (GFMT % "   New table %d[%d] on PID %d, v%d",
+                 ("tableId", "tableIdExtension", "pid", "version")),
+    "tableChange": (GFMT % "   Table %d[%d] on PID %d changed, v%d -> v%d",
+                    ("tableId", "tableIdExtension", "pid", "old", "new")),
+    "tdt": ("   TDT: Actual time is %d:%d:%d %d/%d/%d",
+            ("year", "month", "day", "hour", "minute", "second")),
+    "crc": (RFMT % "   CRC32 does not match: o{%d} m{%d}",
+            ("original", "computed")),
+    "notCurrent": (RFMT % "   PSI has no current flag: ignored", ()),
+    "section": ("   >[%03d] v%d %d/%d",
+                ("tableIdExtension", "version", "section", "last")),
+    "pat": ("      PAT[%d] -> p%d", ("pid", "program")),
+    "pmtOrphan": ("      PMT: PID %d was nor registered in PAT", ("pid",)),
+    "pmt": ("      PMT[%d]: (%d, %d)", ("program", "streamType", "pid")),
+    "pmtTag": ("      PMT TAG[%d]: %s", ("tag", "data")),
+    "sdt": ("      SDT[%d] running: %d", ("serviceId", "running")),
+    "sdtTag": ("      SDT TAG[%d]: %s", ("tag", "data")),
+    "eit": ("      EIT[%d] running: %d", ("eventId", "running")),
+    "eitTime": ("      .      %d-%d-%d %d:%d:%d (%d:%d:%d)",
+                ("year", "month", "day", "hour", "minute", "second",
+                 "hours", "minutes", "seconds")),
+    "eitTag": ("      EIT TAG[%d]: %s", ("tag", "data")),
+    "unrecognized": ("   UNRECOGNIZED %d, %d", ("pid", "tableId")),
+}
+
+
+class PidState():
+    """What is known of a PID that was seen or listed in a PMT"""
+    __slots__ = ("pid", "first", "program", "streamType", "pcr")
+
+    def __init__(self, pid, first=-1):
+        self.pid = pid
+        self.first = first  # Index of its first packet
+        self.program = -1
+        self.streamType = -1
+        self.pcr = -1  # Last PCR
 
 
 class Stream():
     def __init__(self, skipPids, **kw):
         # Load the parameters
         self.skipPids = skipPids
+        self.skip = bytearray(PIDS)  # 1 for the PIDs in skipPids
+        for pid in skipPids:
+            self.skip[pid] = 1
         self.skipPes = kw.pop("skipPes", False)
         self.skipPsi = kw.pop("skipPsi", False)
         self.ignoreAdaptation = kw.pop("ignoreAdaptation", False)
@@ -33,162 +107,311 @@ class Stream():
         self.hideSdt = kw.pop("hideSdt", False)
         self.hideEit = kw.pop("hideEit", False)
         self.hideTdt = kw.pop("hideTdt", False)
+        self.psiCache = None
+        if kw.pop("cachePsi", True):
+            self.psiCache = tstools.SectionCache(
+                kw.pop("onTableChange", self.table_changed))
+        self.sink = kw.pop("sink", None) or sinks.ConsoleSink(EVENTS)
+        self.keepStats = kw.pop("stats", True)
+        self.epgMax = kw.pop("epgMax", epg.EPG_MAX)
+        # Checkpoint file of the state while following (follow=True)
+        self.checkpoint = kw.pop("checkpoint", None)
+        self.checkpointInterval = kw.pop("checkpointInterval",
+                                         CHECKPOINT_INTERVAL)
         self.kw = kw
         self.log = deque()
+        self.sync = tstools.Sync()
+        self.source = None  # Udp source, if any
+        self.follower = None  # iotools.Follower of a followed file
+        self.stats = None
+        self.crc32 = tstools.crc32
+        self.metrics = kw.pop("metrics", None)
+        if self.metrics is not None:
+            self.instrument(self.metrics)
+
+    def instrument(self, metrics):
+        """Time every stage of the parsing with metrics"""
+        for stage in ("feed", "parse_adaptation", "parse_payload",
+                      "parse_PES", "parse_PSI", "crc32"):
+            setattr(self, stage, metrics.timed(stage, getattr(self, stage)))
+        metrics.collect("sync", lambda: {"size": self.sync.size,
+                                         "losses": self.sync.losses,
+                                         "lost": self.sync.lost})
+        if self.psiCache is not None:
+            cache = self.psiCache
+            metrics.collect("psi_cache", lambda: {"hits": cache.hits,
+                                                  "misses": cache.misses})
+
+    def inf(self, kind, *args):
+        """Record an event of the current packet, formatted only if shown"""
+        self.log.append((kind, args))
 
-    def inf(self, s):
-        self.log.append(s)
+    def table_changed(self, pid, tableId, tableIdExtension, old, new):
+        if old is None:
+            self.inf("newTable", tableId, tableIdExtension, pid, new)
+        else:
+            self.inf("tableChange", tableId, tableIdExtension, pid, old, new)
 
     def ignore_pid(self, pid):
         self.skipPids.add(pid)
-        self.packets.pop(pid, None)
+        self.skip[pid] = 1
+        self.pes.drop(pid)
+        self.sections.drop(pid)
 
     def parse(self):
-        """Enter a loop that parses the stream and prints the info"""
+        """Enter a loop that parses the stream and prints the info
+        Files given with follow=True are followed as they grow and rotate
+        and, with a checkpoint path, resume from the last checkpoint"""
         # Prepare the file / udp
         kw = self.kw
-        if "path" in kw:
-            read = iotools.read_file(kw["path"])
+        follow = "path" in kw and kw.get("follow")
+        if "path" in kw and not follow:
             fSize = getsize(kw["path"]) // 188
-        elif "ip" in kw and "port" in kw:
-            read = iotools.read_udp(kw["ip"], kw["port"])
+        elif follow or ("ip" in kw and "port" in kw):
             fSize = float("inf")
         else:
             print(RFMT % "Not enough paramaters given")
             print("Give either a file path or an ip and a port")
             return
-        # Start the variables
+        self.reset(fSize, kw.get("start", 0))
+        blocksKw = dict(kw)
+        if follow and self.checkpoint is not None:
+            resumed = self.load_checkpoint()
+            if resumed is not None:
+                blocksKw["path"], blocksKw["offset"] = resumed
+                print(GFMT % ("Resuming %s at byte %d" % resumed))
+        blocks = tstools.open_blocks(blocksKw)
+        self.source = blocksKw.get("source")
+        self.follower = blocksKw.get("follower")
+        if self.follower is not None and self.checkpoint is not None:
+            blocks = self.checkpointed(blocks)
+        metrics = self.metrics
+        if metrics is None:
+            self.feed(tstools.walk(blocks, (), self.sync))
+            return
+        blocks = metrics.timed_iter("read", blocks)
+        self.feed(metrics.counted("packets",
+                                  tstools.walk(blocks, (), self.sync)))
+
+    def checkpointed(self, blocks):
+        """Yield blocks, saving a checkpoint every checkpointInterval
+        seconds when the next one is asked (every packet before is parsed
+        by then, only the cut one at the end is left, sync.pending)"""
+        last = monotonic()
+        for block in blocks:
+            yield block
+            if monotonic() - last >= self.checkpointInterval:
+                self.save_checkpoint()
+                last = monotonic()
+        self.save_checkpoint()
+
+    def save_checkpoint(self):
+        """Write the state and the position of the followed file to the
+        checkpoint file (replacing it at once)"""
+        state = dict((name, getattr(self, name)) for name in CHECKPOINT)
+        # self.index only moves when feed returns, every packet is walked
+        state["index"] = (self.kw.get("start", 0) + self.sync.packets) * 100
+        if self.psiCache is not None:
+            state["psiCache"] = (self.psiCache.sections,
+                                 self.psiCache.versions)
+        follower = self.follower
+        offset = max(follower.offset - self.sync.pending, 0)
+        temporary = self.checkpoint + ".tmp"
+        with open(temporary, "wb") as f:
+            pickle.dump((CHECKPOINT_VERSION, follower.path, offset, state), f,
+                        pickle.HIGHEST_PROTOCOL)
+        replace(temporary, self.checkpoint)
+
+    def load_checkpoint(self):
+        """Restore the state in the checkpoint file and return the path
+        and byte offset to go on from, None if there is no usable one"""
+        try:
+            with open(self.checkpoint, "rb") as f:
+                version, path, offset, state = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        if (version != CHECKPOINT_VERSION or not exists(path) or
+                getsize(path) < offset):
+            return None
+        psiCache = state.pop("psiCache", None)
+        for name, value in state.items():
+            setattr(self, name, value)
+        if psiCache is not None and self.psiCache is not None:
+            self.psiCache.sections, self.psiCache.versions = psiCache
+        return path, offset
+
+    def reset(self, fSize=float("inf"), start=0):
+        """Start the tables and state of a new stream
+        fSize (packets) and start (packet index) are for the progress"""
+        self.fSize = fSize
+        self.index = start * 100
         self.td = (0, 0, 0, 0, 0, 0)
         self.pat = {}
-        self.packets = {}
+        self.pes = tstools.PesAssembler()
+        self.timing = {}  # pid -> (pts, dts) of its last PES
+        self.sections = tstools.Sections()
         self.pmt = {}
         self.pcr = {}
         self.sdt = {}
-        self.eit = {}
+        self.eit = epg.Epg(self.epgMax)
+        # Next continuity counter, -1 if new, + 16 after no payload
+        self.counters = [-1] * PIDS
+        self.programs = [-1] * PIDS  # Program of the PMT PIDs
+        self.states = [None] * PIDS  # PidState
         self.cShow = False
+        if self.psiCache is not None:  # Its tables are the ones above
+            self.psiCache.clear()
+        if self.keepStats:
+            self.stats = stats.Stats(self.sync, start)
+
+    def feed(self, packets):
+        """Parse an iterable of packets, continuing the previous ones"""
         # Load the local ones
         log = self.log
+        log_append = log.append
         log_clear = log.clear
+        sink_emit = self.sink.emit
+        if self.metrics is not None:
+            sink_emit = self.metrics.timed("emit", sink_emit)
         s_inf = self.inf
         s_parse_adaptation = self.parse_adaptation
         s_parse_payload = self.parse_payload
-        pat = self.pat
-        skipPids = self.skipPids
+        skip = self.skip
+        counters = self.counters
+        states = self.states
         ignoreAdaptation = self.ignoreAdaptation
         ignorePayload = self.ignorePayload
         hideNotPusi = self.hideNotPusi
-        lastCounter = {}
-        for i in count(0, 100):
+        fSize = self.fSize
+        i = self.index - 100
+        stats = self.stats
+        if stats is not None:
+            packetsCount = stats.packets
+            psiLimit = stats.psiLimit
+            count_psi = stats.count_psi
+        else:  # Counted in a list that is thrown away
+            packetsCount = [0] * PIDS
+            psiLimit = bytes(PIDS)  # Never checked
+        for i, packet in zip(count(self.index, 100), packets):
             # Read the least information possible in case of skiping
-            try:
-                sync = read(1)[0]
-            except IndexError:
-                if i // 100 == fSize:
-                    break
-            if sync != 0x47:
-                raise Exception("Sync should be 0x47, it is 0x%x" % sync)
-            flagsAndPid = read(2)
-            pid = ((flagsAndPid[0] & 0x1F) << 8) + flagsAndPid[1]
-            if pid in skipPids:
-                read(185)
+            b1 = packet[1]
+            pid = PID_HIGH[b1] + packet[2]
+            packetsCount[pid] += 1  # The skipped PIDs too
+            if b1 & 0x40 and psiLimit[pid]:
+                count_psi(pid)
+            if skip[pid]:
                 continue
             # Show log of previous packet
             if self.cShow and log:
-                print("\n".join(log))
+                sink_emit(log)
             log_clear()
             self.cShow = True
             # Read the rest of the flags and print
-            tei = (flagsAndPid[0] & 0x80) >> 7
-            pusi = (flagsAndPid[0] & 0x40) >> 6
-            priority = (flagsAndPid[0] & 0x20) >> 5
-            extraFlags = read(1)[0]
-            tsc = (extraFlags & 0xC0) >> 6
-            counter = extraFlags & 0x0F
-            s_inf(PFMT % (pid, counter, tei, pusi, priority, tsc, i / fSize))
+            tei, pusi, priority = BYTE1[b1]
+            tsc, aF, pF, counter = BYTE3[packet[3]]
+            log_append(("packet", (pid, counter, tei, pusi, priority, tsc,
+                                   i / fSize)))
             if hideNotPusi and not pusi:
                 self.cShow = False
             # Check for errors in the packet
             if tei:
-                s_inf(RFMT % "\033[7Transport Error Indicator (TEI)\033[0")
-            last = lastCounter.pop(pid, -1)
-            if last != counter:
-                if last == -1:
-                    s_inf(GFMT % "First time we receive this PID")
-                else:
-                    s_inf(RFMT % ("Counter discontinuity, from %d to %d" %
-                          (last, counter)))
-            lastCounter[pid] = (counter + 1 if extraFlags & 0x10 else 0) % 16
-            left = 184
+                s_inf("tei")
+                if stats is not None:
+                    stats.tei[pid] += 1
+            expected = counters[pid]
+            if expected != counter or not pF:
+                if expected == -1:
+                    s_inf("newPid")
+                    if states[pid] is None:
+                        states[pid] = PidState(pid)
+                    states[pid].first = i // 100
+                # Stuffing counters mean nothing
+                elif pid != 8191 and counter != expected - 16:
+                    if expected != counter:
+                        s_inf("discontinuity", expected & 0x0F, counter)
+                    # The stats allow a packet with the counter of the last
+                    # one (a duplicate, or the one after a packet without
+                    # payload) and the discontinuity indicator, a packet
+                    # without payload must not move it
+                    last = (expected - 16 if expected > 15 else
+                            (expected - 1) & 0x0F)
+                    if (stats is not None and counter != last and
+                            not (pF and counter == (last + 1) & 0x0F) and
+                            not (aF and packet[4] and packet[5] & 0x80)):
+                        stats.ccErrors[pid] += 1
+            # Without payload the counter does not move (+ 16 to know it)
+            counters[pid] = (counter + 1) & 0x0F if pF else counter + 16
+            left = 4
             # Parse adaptation
-            if extraFlags & 0x20:
-                length = read(1)[0]
+            if aF:
+                length = packet[4]
                 if length:
-                    adaptation = read(length)
+                    if stats is not None and length >= 7 and packet[5] & 0x10:
+                        stats.count_pcr(pid, tstools.parse_pcr(packet[6:12]),
+                                        packet[5] & 0x80, i // 100)
                     if not ignoreAdaptation:
-                        s_parse_adaptation(adaptation)
-                left -= length + 1
-            # Parse payload
-            if extraFlags & 0x10:
-                payload = read(left)
-                if not ignorePayload:
-                    self.cPid = pid
-                    self.cPusi = pusi
-                    try:
-                        self.cProgram = pat[pid]
-                    except KeyError:
-                        self.cProgram = -1
-                    s_parse_payload(payload)
+                        s_parse_adaptation(pid, packet[5:5 + length])
+                left += length + 1
+            # Parse payload (none if the adaptation takes the packet)
+            if pF and not ignorePayload and left < 188:
+                s_parse_payload(pid, pusi, packet[left:])
+        self.index = i + 100
 
-    def parse_adaptation(self, data):
+    def parse_adaptation(self, pid, data):
         """Parse very few parameters of adaptation
             There are 8 bit flags in the following order:
                 [0] discontinuity, [1] rai, [2] streamPriority, [3] pcr,
                 [4] opcr, [5] splice, [6] private, [7] extension"""
         s_inf = self.inf
         flags = tstools.toBits(data[0])
-        s_inf("   ADAPTATION (%03d) %d|%d|%d|%d|%d|%d|%d|%d" %
-              (len(data), *flags))
+        s_inf("adaptation", len(data), *flags)
         if flags[3]:
             pcr = tstools.parse_pcr(data[1:7])
-            s_inf("   PCR -> %d" % pcr)
+            s_inf("pcr", pcr)
+            self.states[pid].pcr = pcr
             if flags[4]:
                 opcr = tstools.parse_pcr(data[7:13])
-                s_inf("   OPCR -> %d" % opcr)
+                s_inf("opcr", opcr)
         # Rest of the data is ignored
 
-    def parse_payload(self, data):
-        cPid = self.cPid
-        packets = self.packets
-        if self.cPusi:
+    def parse_payload(self, cPid, pusi, data):
+        pes = self.pes
+        sections = self.sections
+        if pusi:
             if data[0] | data[1] == 0 and data[2] == 1:  # PES
                 if self.skipPes:
                     self.ignore_pid(cPid)
                     self.cShow = False
                     return
-                if cPid in packets:
-                    print("It is", len(packets[cPid]))  # TODO: PARSE PES
-                packets[cPid] = data[3:]
+                self.parse_PES(pes.feed(cPid, 1, data))
+                sections.drop(cPid)
+                return
             elif (data[0] == 0x47 and data[1] | 0x80 == 0xE0 and
                   data[2] == 0x0F):  # DVB-MIP
-                self.inf("\n\n\n\n\n" + RFMT % ("DVB-MIP is not implemented"))
+                self.inf("mip")
                 return
-            else:  # PSI
-                if self.skipPsi:
-                    self.ignore_pid(cPid)
-                    self.cShow = False
-                    return
-                if cPid in packets:
-                    self.parse_PSI(packets[cPid])
-                packets[cPid] = data[data[0] + 1:]
-        else:
-            try:
-                packets[cPid] += data
-            except KeyError:
-                self.inf(RFMT % "Incomplete data does not match previous PID")
+            elif self.skipPsi:
+                self.ignore_pid(cPid)
+                self.cShow = False
+                return
+            pes.drop(cPid)
+        elif cPid in pes:
+            self.parse_PES(pes.feed(cPid, 0, data))
+            return
+        elif cPid not in sections:
+            self.inf("incomplete")
+            return
+        for section in sections.feed(cPid, pusi, data):
+            self.parse_PSI(cPid, section)
+
+    def parse_PES(self, done):
+        """Record the timing of the completed PES headers"""
+        for p in done:
+            self.timing[p.pid] = (p.pts, p.dts)
+            self.inf("pes", p.pid, p.streamId, p.size, p.pts, p.dts)
 
-    def parse_PSI(self, data):
+    def parse_PSI(self, cPid, data):
         s_inf = self.inf
-        cPid = self.cPid
         # Get headers
         tableId = data[0]
         syntaxF = (data[1] & 0x80) >> 7
@@ -196,7 +419,7 @@ class Stream():
         length = ((data[1] & 0x0F) << 8) + data[2] + 3
         if length < len(data):
             data = data[:length]
-        s_inf("   PSI[%03d] (%d) %d|%d" % (tableId, length, syntaxF, privateF))
+        s_inf("psi", tableId, length, syntaxF, privateF)
         # Checking TDT since it is a special shorter table
         if cPid == 20:  # TDT (and TOT)
             if tableId != 112:  # TDT
@@ -207,16 +430,30 @@ class Stream():
             data = data[-5:]
             date = tstools.parse_mjd(data)
             time = tstools.parse_bcd(data[2:])
-            s_inf("   TDT: Actual time is %d:%d:%d %d/%d/%d" % (*date, *time))
+            s_inf("tdt", *date, *time)
             self.td = (*date, *time)
+            self.eit.set_time(tstools.parse_utc(data))
+            return
+        # Skip the sections already parsed
+        psiCache = self.psiCache
+        if psiCache is not None and psiCache.hit(cPid, data):
+            self.cShow = False
             return
         # Check CRC32
+        if length < 7:  # Not even room for it
+            self.cShow = False
+            return
         originalCrc = tstools.parse_crc(data[-4:])
-        data = data[:-4]
-        myCrc = tstools.crc32(data)
+        myCrc = self.crc32(data[:-4])
         if originalCrc != myCrc:
-            s_inf(RFMT % ("   CRC32 does not match: o{%d} m{%d}" %
-                  (originalCrc, myCrc)))
+            s_inf("crc", originalCrc, myCrc)
+            if self.stats is not None:
+                self.stats.crcErrors[cPid] += 1
+            return  # Corrupted, its lengths can not be trusted
+        whole = data
+        if psiCache is not None:
+            psiCache.update(cPid, data)
+        data = data[:-4]
         # Get extended headers
         if not (syntaxF and length):
             return
@@ -227,9 +464,8 @@ class Stream():
         last = data[7]
         data = data[8:]
         if not currentF:
-            s_inf(RFMT % "   PSI has no current flag: ignored")
-        s_inf("   >[%03d] v%d %d/%d" %
-              (tableIdExtension, version, section, last))
+            s_inf("notCurrent")
+        s_inf("section", tableIdExtension, version, section, last)
         # Clasify the table
         if not (cPid or tableId or privateF):  # PAT
             if self.hidePat:
@@ -238,33 +474,42 @@ class Stream():
             for i in range(0, len(data), 4):
                 programNum = (data[i] << 8) + data[i + 1]
                 programPid = ((data[i + 2] & 0x1F) << 8) + data[i + 3]
-                s_inf("      PAT[%d] -> p%d" % (programPid, programNum))
+                s_inf("pat", programPid, programNum)
                 self.pat[programPid] = programNum
+                self.programs[programPid] = programNum
+                if programNum and self.stats is not None:
+                    self.stats.watch(programPid)
         elif tableId == 2 and not privateF:  # PMT
             if self.hidePmt:
                 self.cShow = False
-            if self.cProgram == -1:
-                s_inf("      PMT: PID %d was nor registered in PAT")
+            program = self.programs[cPid]
+            if program == -1:  # Not cached, parsed again once in the PAT
+                s_inf("pmtOrphan", cPid)
                 return
             # Get the PCR associated
             pcrPid = ((data[0] & 0x1F) << 8) + data[1]
-            self.pcr[self.cProgram] = pcrPid
+            self.pcr[program] = pcrPid
             # Parse program descriptors
             programLength = ((data[2] & 0x03) << 8) + data[3]
             data, programD = tstools.parse_descriptors(data[4:], programLength)
             for dTag, dData in programD:
-                s_inf("      PMT TAG[%d]: %s" % (dTag, str(dData)))
+                s_inf("pmtTag", dTag, dData)
             while data:
                 # Get type and pid of the ES
                 sType = data[0]
                 ePid = ((data[1] & 0x1F) << 8) + data[2]
-                self.pmt[self.cProgram] = (sType, ePid)
-                s_inf("      PMT[%d]: (%d, %d)" % (self.cProgram, sType, ePid))
+                self.pmt[program] = (sType, ePid)
+                s_inf("pmt", program, sType, ePid)
+                state = self.states[ePid]
+                if state is None:
+                    state = self.states[ePid] = PidState(ePid)
+                state.program = program
+                state.streamType = sType
                 # Parse ES descriptors
                 esLength = ((data[3] & 0x03) << 8) + data[4]
                 data, esD = tstools.parse_descriptors(data[5:], esLength)
                 for dTag, dData in esD:
-                    s_inf("      PMT TAG[%d]: %s" % (dTag, str(dData)))
+                    s_inf("pmtTag", dTag, dData)
         elif cPid == 17:  # SDT
             if self.hideSdt:
                 self.cShow = False
@@ -274,7 +519,7 @@ class Stream():
                 # Parse headers
                 serviceId = (data[0] << 8) + data[1]
                 running = (data[3] & 0xE0) >> 5
-                s_inf("      SDT[%d] running: %d" % (serviceId, running))
+                s_inf("sdt", serviceId, running)
                 # Parse descriptors
                 length = ((data[3] & 0x0F) << 8) + data[4]
                 data, descriptors = tstools.parse_descriptors(data[5:], length)
@@ -282,71 +527,44 @@ class Stream():
                     if dTag == 72:  # Service descriptor
                         serviceType = dData[0]
                         _length = dData[1]
-                        serviceProvider = tstools.try_decode(dData[2:_length + 2])
-                        serviceName = tstools.try_decode(dData[_length + 3:])
+                        serviceProvider = dvbtext.decode(dData[2:_length + 2])
+                        serviceName = dvbtext.decode(dData[_length + 3:])
                         self.sdt[serviceId] = (serviceType, serviceProvider,
                                                serviceName)
                     elif dTag == 93:  # Multilingual
                         pass
                     else:
-                        s_inf("      SDT TAG[%d]: %s" % (dTag, str(dData)))
+                        s_inf("sdtTag", dTag, dData)
         elif cPid == 18:  # EIT
             if self.hideEit:
                 self.cShow = False
-            if tableId not in EIT_ACTUAL:
+            if tableId not in EIT_ACTUAL:  # Not parsed
                 self.cShow = False
-                return
-            eventList = []
-            # Ignoring tsId, OnId, lastN, lastId (6 bytes)
-            data = data[6:]
-            while data:
-                # Parse headers
-                eventId = (data[0] << 8) + data[1]
-                date = tstools.parse_mjd(data[2:])
-                hour = tstools.parse_bcd(data[4:])
-                duration = tstools.parse_bcd(data[7:])
-                running = (data[10] & 0xE0) >> 5
-                s_inf("      EIT[%d] running: %d" % (eventId, running))
-                s_inf("      .      %d-%d-%d %d:%d:%d (%d:%d:%d)" %
-                      (*date, *hour, *duration))
-                event = {"info": "", "extended": "", "date": date,
-                         "hour": hour, "duration": duration, "streams": []}
-                # Parse descriptors
-                length = ((data[10] & 0x0F) << 8) + data[11]
-                data, descriptors = tstools.parse_descriptors(data[12:], length)
-                for dTag, dData in descriptors:
-                    if dTag == 77:  # Info
-                        lang = tstools.try_decode(dData[:3])
-                        _length = dData[3]
-                        eventName = tstools.try_decode(dData[4:_length + 4])
-                        text = tstools.try_decode(dData[_length + 5:])
-                        event["info"] = ";".join((lang, eventName, text))
-                    elif dTag == 78:  # Extended
-                        number = (dData[0] & 0xF0) >> 4
-                        lang = tstools.try_decode(dData[1:4])
-                        offset = dData[4] + 6
-                        text = tstools.try_decode(dData[offset:])
-                        if number == 0:
-                            t = ";".join((lang, text))
-                            event["extended"] = t + event["extended"]
-                        else:
-                            event["extended"] += text
-                    elif dTag == 80:  # Component
-                        content = dData[0] & 0x0F
-                        lang = tstools.try_decode(dData[3:6])
-                        event["streams"].append((lang, content))
-                    else:
-                        s_inf("      EIT TAG[%d]: %s" % (dTag, str(dData)))
-                eventList.append(event)
-            self.eit[tableIdExtension] = eventList
+            else:
+                # Ignoring tsId, OnId, lastN, lastId (6 bytes)
+                events = self.eit.add_section(tableIdExtension, tableId,
+                                              version >> 1, section, data[6:])
+                for event in events:
+                    s_inf("eit", event.eventId, event.running)
+                    times = event.times()
+                    if times is not None:  # Undefined for NVOD references
+                        s_inf("eitTime", *times[0], *times[1], *times[2])
+                    for dTag, dData in event.descriptors():
+                        # Info, extended and component are in the EPG
+                        if dTag not in (77, 78, 80):
+                            s_inf("eitTag", dTag, dData)
         elif tableId == 116:  # application information section
             self.ignore_pid(cPid)
             self.cShow = False
         else:
-            s_inf("   UNRECOGNIZED %d, %d" % (cPid, tableId))
+            s_inf("unrecognized", cPid, tableId)
+        # Only once parsed, a repetition can be skipped
+        if psiCache is not None:
+            psiCache.store(cPid, whole)
 
 
-def main(**kw):
+def skip_pids(kw):
+    """Pop targetPids / skipPids from kw and return the PIDs to skip"""
     if "targetPids" in kw:
         skipPids = set(range(1 << 13)) - set(kw.pop("targetPids"))
     else:
@@ -355,6 +573,24 @@ def main(**kw):
     skipPids.add(21)  # Network synchronization
     skipPids.add(1)  # CAT
     skipPids.add(16)  # NIT
+    return skipPids
+
+
+def main(**kw):
+    """Parse the stream in kw, write its tables to output and wait for
+    enter unless pause=False or there is no terminal"""
+    skipPids = skip_pids(kw)
+    pause = kw.pop("pause", True) and sys.stdin.isatty()
+    exporter = sampler = None
+    metricsPath = kw.pop("metricsPath", None)
+    metricsPort = kw.pop("metricsPort", None)
+    profile = kw.pop("profile", False)
+    if metricsPath or metricsPort or profile:
+        import metrics
+        kw["metrics"] = metrics.Metrics()
+        exporter = metrics.Exporter(kw["metrics"], metricsPath, metricsPort)
+        if profile:
+            sampler = metrics.Sampler(kw["metrics"])
     stream = Stream(skipPids, **kw)
     try:
         stream.parse()
@@ -364,9 +600,15 @@ def main(**kw):
         print(RFMT % str(e))
         exception(e)
         print("Happened while parsing:")
-        print("\n".join(stream.log))
+        print(sinks.render(EVENTS, stream.log))
     else:
         print(RFMT % "END OF FILE")
+    finally:
+        stream.sink.close()  # Flushes a JsonSink
+    if sampler is not None:
+        sampler.stop()
+    if exporter is not None:
+        exporter.stop()
     with open("output", "w") as f:
         print("PAT", file=f)
         pprint(stream.pat, stream=f)
@@ -375,9 +617,26 @@ def main(**kw):
         print("\n\nSDT", file=f)
         pprint(stream.sdt, stream=f)
         print("\n\nEIT", file=f)
-        pprint(stream.eit, stream=f)
+        pprint(stream.eit.as_dict(), stream=f)
+        if stream.stats is not None:
+            print("\n\nSTATS", file=f)
+            pprint(stream.stats.snapshot(), stream=f)
     print("Time and Date was %d/%d/%d %d:%d:%d" % stream.td)
-    while True:
+    sync = stream.sync
+    print("Packets of %d bytes, sync lost %d times (%d bytes skipped)" %
+          (sync.size, sync.losses, sync.lost))
+    if stream.stats is not None:
+        snapshot = stream.stats.snapshot()
+        print("ETR 290 priority 1: %s" % snapshot["priority1"])
+        print("ETR 290 priority 2: %s" % snapshot["priority2"])
+    if stream.follower is not None:
+        print("Followed %(segments)d segments, stopped in %(path)s at "
+              "byte %(offset)d" % stream.follower.stats())
+    if stream.source is not None:
+        print("UDP: %(datagrams)d datagrams in %(batches)d batches, "
+              "%(rtpLost)d lost (RTP), %(dropped)s dropped, %(queued)s queued"
+              % stream.source.stats())
+    while pause:
         try:
             input("\rPress enter to exit")
         except KeyboardInterrupt:
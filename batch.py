@@ -0,0 +1,125 @@
+#! python3
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from json import dump
+from os import cpu_count
+from os.path import basename, getsize, isdir, join
+from time import perf_counter, strftime
+import analyzer
+import sinks
+
+"""
+Summary of many recording segments at once: every .ts file of a folder
+(or of a glob) is parsed on its own by a pool of worker processes
+and a single JSON report is written with, for every file, its timing,
+error if any, sync, ETR 290 counters and the tables in effect at its end
+Files are taken in name order (the recorder names them by start time),
+tables are carried from one segment to the next: a table missing at
+the start of a segment (not repeated yet) is the one of the previous
+segment, and EPG events are kept until a later segment replaces them
+"""
+
+RFMT = "\033[1m\033[91m%s\033[0m"
+GFMT = "\033[1;32m%s\033[0m"
+EXTENSION = ".ts"
+WORKERS = max((cpu_count() or 2) - 1, 1)
+TABLES = ("pat", "pmt", "pcr", "sdt")
+
+
+def segments(source):
+    """Return the capture files of a folder or glob sorted by name"""
+    if isdir(source):
+        source = join(source, "*" + EXTENSION)
+    return sorted(glob(source), key=basename)
+
+
+def summarize(path, **kw):
+    """Parse the capture at path like analyzer.main (without output) and
+    return what the report keeps of it, errors included"""
+    kw = dict(kw, path=path, sink=sinks.NullSink(), stats=True)
+    stream = analyzer.Stream(analyzer.skip_pids(kw), **kw)
+    stream.reset()  # Empty tables if the file can not be opened
+    result = {"path": path, "error": None}
+    start = perf_counter()
+    try:
+        result["bytes"] = getsize(path)
+        stream.parse()
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    result["seconds"] = perf_counter() - start
+    sync = stream.sync
+    result["sync"] = {"size": sync.size, "losses": sync.losses,
+                      "lost": sync.lost, "packets": sync.packets}
+    result["td"] = stream.td
+    for table in TABLES:
+        result[table] = getattr(stream, table)
+    result["eit"] = stream.eit.as_dict()
+    snapshot = stream.stats.snapshot()  # The report always has them
+    result["priority1"] = snapshot["priority1"]
+    result["priority2"] = snapshot["priority2"]
+    return result
+
+
+def carry(tables, result):
+    """Update the tables carried so far with the ones of result (taken
+    off it) and return them, events are merged by start time (NVOD
+    references, without one, by name after the others)"""
+    for table in TABLES:
+        tables[table].update(result.pop(table))
+    epg = tables["eit"]
+    for serviceId, events in result.pop("eit").items():
+        service = epg.setdefault(serviceId, {})
+        for event in events:
+            if event["date"] is None:
+                service[1, event["info"]] = event
+            else:
+                service[(0,) + event["date"] + event["hour"]] = event
+    return tables
+
+
+def run(source, workers=WORKERS, **kw):
+    """Summarize every segment of source with up to workers processes
+    kw are given to every analyzer.Stream, return the report"""
+    paths = segments(source)
+    tables = dict((table, {}) for table in TABLES + ("eit",))
+    files = []
+    start = perf_counter()
+    with ProcessPoolExecutor(max(min(workers, len(paths)), 1)) as pool:
+        futures = [pool.submit(summarize, path, **kw) for path in paths]
+        for path, future in zip(paths, futures):
+            try:
+                result = future.result()
+            except Exception as e:  # The worker itself failed
+                result = {"path": path, "error": "%s: %s" % (
+                    type(e).__name__, e)}
+            else:
+                carry(tables, result)
+                result["tables"] = dict((table, dict(tables[table]))
+                                        for table in TABLES)
+            files.append(result)
+            if result["error"] is None:
+                print(GFMT % ("%s %.3f s" % (path, result["seconds"])))
+            else:
+                print(RFMT % ("%s %s" % (path, result["error"])))
+    eit = dict((serviceId, [events[k] for k in sorted(events)])
+               for serviceId, events in tables.pop("eit").items())
+    return {"date": strftime("%Y-%m-%d %H:%M:%S"), "source": source,
+            "workers": workers, "seconds": perf_counter() - start,
+            "errors": sum(1 for f in files if f["error"] is not None),
+            "files": files, "tables": dict(tables, eit=eit)}
+
+
+def save(report, path):
+    with open(path, "w") as f:
+        dump(report, f, indent=2)
+
+
+def main(source, out="report.json", **kw):
+    report = run(source, **kw)
+    save(report, out)
+    print("%d files in %.3f s, %d errors, report in %s" %
+          (len(report["files"]), report["seconds"], report["errors"], out))
+
+
+if __name__ == "__main__":
+    main("/home/huxley/Desktop/", skipPes=True)
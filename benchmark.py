@@ -0,0 +1,410 @@
+#! python3
+import asyncio
+from contextlib import redirect_stdout
+from io import StringIO
+from json import dump, load
+from os import remove, urandom
+from os.path import exists, getsize, join
+from platform import python_version
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter, strftime
+import analyzer
+import iotools
+import monitor
+import parallel
+import saver
+import sinks
+import tsgen
+import tstools
+import vectools
+
+"""
+Throughput of the hot paths over a synthetic multiplex (tsgen), the
+results are saved as JSON so runs can be compared with compare()
+"""
+
+RFMT = "\033[1m\033[91m%s\033[0m"
+GFMT = "\033[1;32m%s\033[0m"
+BFMT = "%-24s %12.0f packets/s %9.2f MB/s"
+PACKETS = 200000  # Packets of the synthetic multiplex
+REPEAT = 3  # Runs of every case, the best one counts
+
+
+def check_crc32(rounds=2000, seed=0):
+    """Compare crc32 against the byte by byte reference implementation"""
+    rand = Random(seed)
+    cases = [b"", b"\x00", b"\xff" * 4, bytes(range(256)) * 16]
+    for _ in range(rounds):
+        length = rand.randrange(4097)
+        cases.append(bytes(rand.getrandbits(8) for _ in range(length)))
+    failed = 0
+    for b in cases:
+        if tstools.crc32(b) != tstools.crc32_table(b):
+            failed += 1
+        if not tstools.check_crc(b + tstools.crc32(b).to_bytes(4, "big")):
+            failed += 1
+        if tstools.crc32(memoryview(b)) != tstools.crc32(b):
+            failed += 1
+    return (len(cases), failed)
+
+
+def check_escr(rounds=2000, seed=0):
+    """Round-trip ESCR values (33 bits of base and 9 of extension) through
+    tsgen.escr_field and parse_based_timestamp_2. Return the wrong ones"""
+    rand = Random(seed)
+    cases = [0, 299, (1 << 15) * 300, 0x1FFFFFFFF * 300 + 299]
+    cases += [rand.getrandbits(33) * 300 + rand.randrange(300)
+              for _ in range(rounds)]
+    return [escr for escr in cases if
+            tstools.parse_based_timestamp_2(tsgen.escr_field(escr)) != escr]
+
+
+def check_stats_cc(packets=20000):
+    """PCRs in packets without payload and duplicated packets are no
+    continuity errors. Return the ones the stats counted"""
+    with TemporaryDirectory() as folder:
+        path = join(folder, "pcr_only.ts")
+        tsgen.generate(path, packets, pcrOnly=True, errors={"dup": 1e-2})
+        stream = analyzer.Stream(set(), path=path, sink=sinks.NullSink())
+        stream.parse()
+    return sum(stream.stats.ccErrors)
+
+
+def check_pmt_first(packets=20000):
+    """A PMT seen before its PAT must be parsed when it repeats, with
+    the PSI cache on as with it off. Return the programs found by each"""
+    found = []
+    with TemporaryDirectory() as folder:
+        path = join(folder, "pmt_first.ts")
+        with open(path, "wb") as f:  # Without the first PAT packet
+            f.write(b"".join(tsgen.Multiplex().packets(packets))[188:])
+        for cachePsi in (True, False):
+            stream = analyzer.Stream(set(), path=path, cachePsi=cachePsi,
+                                     sink=sinks.NullSink())
+            stream.parse()
+            found.append((sorted(stream.pmt), sorted(stream.pcr)))
+    return found
+
+
+def check_reparse(packets=20000):
+    """A Stream parsing a file a second time must find the same tables
+    (with the PSI cache on). Return the tables of both passes"""
+    found = []
+    with TemporaryDirectory() as folder:
+        path = join(folder, "twice.ts")
+        tsgen.generate(path, packets)
+        stream = analyzer.Stream(set(), path=path, sink=sinks.NullSink())
+        for _ in range(2):
+            stream.parse()
+            found.append((dict(stream.pat), dict(stream.pmt),
+                          dict(stream.sdt)))
+    return found
+
+
+def check_parallel(packets=50000, chunks=64):
+    """The chunked analysis of a multiplex with garbage between packets
+    (with stray sync bytes), PCRs in packets without payload and cc and
+    duplicate errors must match the sequential one and analyzer.Stream.
+    Return the keys of the summaries that differ"""
+    rand = Random(0)
+    data = bytearray()
+    multiplex = tsgen.Multiplex(pcrOnly=True, errors={
+        "sync": 5e-3, "cc": 1e-3, "dup": 1e-3})
+    for packet in multiplex.packets(packets):
+        if rand.random() < 5e-3:
+            data += bytes(rand.choice((0x47, rand.randrange(256)))
+                          for _ in range(rand.randrange(1, 600)))
+        data += packet
+    with TemporaryDirectory() as folder:
+        path = join(folder, "garbage.ts")
+        with open(path, "wb") as f:
+            f.write(data)
+        chunked = parallel.summary(parallel.analyze(path, 2, chunks))
+        sequential = parallel.summary(parallel.analyze_sequential(path))
+        stream = analyzer.Stream(set(), path=path, sink=sinks.NullSink())
+        stream.parse()
+    stats = stream.stats
+    analyzed = {"packets": stats.packets, "ccErrors": stats.ccErrors,
+                "pcrCount": stats.pcrCount}
+    analyzed = dict((k, dict((pid, n) for pid, n in enumerate(v) if n))
+                    for k, v in analyzed.items())
+    analyzed.update(pat=stream.pat, lostBytes=stream.sync.lost)
+    return ([k for k in sequential if chunked[k] != sequential[k]] +
+            ["Stream " + k for k in analyzed if analyzed[k] != sequential[k]])
+
+
+def check_vectools_sync(packets=20000):
+    """The vectorized loop must go through sync losses like tstools.loop
+    Return (packets, bytes lost) of both, None without numpy"""
+    if vectools.np is None:
+        return None
+    found = []
+    with TemporaryDirectory() as folder:
+        path = join(folder, "sync.ts")
+        tsgen.generate(path, packets, errors={"sync": 1e-3})
+        for module, sync in ((tstools, tstools.Sync()),
+                             (vectools, tstools.Sync(188))):
+            walked = sum(1 for _ in module.loop(path=path, sync=sync))
+            found.append((walked, sync.lost))
+    return found
+
+
+def check_save_sizes(packets=5000):
+    """saver.save_runs must keep the records of M2TS (192) and FEC (204)
+    input whole. Return the sizes whose output differs"""
+    data = b"".join(tsgen.Multiplex().packets(packets))
+    wrong = []
+    with TemporaryDirectory() as folder:
+        for size in (192, 204):
+            records = []
+            kept = []
+            for i in range(0, len(data), 188):
+                packet = data[i:i + 188]
+                if size == 192:
+                    records.append(i.to_bytes(4, "big") + packet)
+                else:
+                    records.append(packet + bytes(16))
+                if ((packet[1] & 0x1F) << 8) + packet[2] != 0x101:
+                    kept.append(records[-1])
+            path = join(folder, "%d.ts" % size)
+            with open(path, "wb") as f:
+                f.write(b"".join(records))
+            out = join(folder, "%d.out.ts" % size)
+            with redirect_stdout(StringIO()):
+                saver.save_runs(out, path=path, skipPids=(0x101,))
+            with open(out, "rb") as f:
+                if f.read() != b"".join(kept):
+                    wrong.append(size)
+    return wrong
+
+
+def check_writer_error(items=10000):
+    """A write that fails must reach the producer instead of leaving it
+    waiting for room forever. Return what put_many and stop raised"""
+    def write(batch):
+        raise OSError(28, "No space left on device")
+    raised = []
+    with redirect_stdout(StringIO()):
+        writer = iotools.Writer((write, "complex"), maxQueue=16)
+        for call in (lambda: writer.put_many([b"\x47" * 188] * items),
+                     writer.stop):
+            try:
+                call()
+            except OSError as e:
+                raised.append(e.errno)
+    return raised
+
+
+def check_rotation():
+    """A followed segment must go on with the next one of its own
+    rotation only. Return the wrong (name, next) pairs"""
+    rotations = [("20180727-145000-20180727-145500-RGE1_CAT2_REC.ts",
+                  "20180727-145500-20180727-150000-RGE1_CAT2_REC.ts"),
+                 ("20180727-145500-20180727-150000-RGE1_CAT2_REC.ts", None),
+                 ("capture9.ts", "capture10.ts"), ("save.ts", None)]
+    unrelated = ["20180727-145500-20180727-150000-RGE2_CAT2_REC.ts",
+                 "zzz.ts"]
+    wrong = []
+    with TemporaryDirectory() as folder:
+        for name in unrelated + [n for pair in rotations for n in pair if n]:
+            open(join(folder, name), "wb").close()
+        for name, expected in rotations:
+            found = iotools.Follower(join(folder, name)).next_segment()
+            if found != (expected and join(folder, expected)):
+                wrong.append((name, found))
+    return wrong
+
+
+def check_monitor_stopped(port=45678):
+    """The counters of a monitor must still be read after it stopped
+    (and closed its sockets). Return the error raised, None if none"""
+    watch = monitor.Monitor([("127.0.0.1", port)], onStats=None)
+    try:
+        asyncio.run(watch.run(0.1))
+        watch.snapshot()
+    except OSError as e:
+        return e
+    return None
+
+
+def bench_crc32(function, size=4096, seconds=1.0):
+    """Return the MB/s that function processes on sections of size bytes"""
+    data = urandom(size)
+    done = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        function(data)
+        done += size
+    return done / (perf_counter() - start) / 1e6
+
+
+def consume(iterable):
+    for _ in iterable:
+        pass
+
+
+def run_stream(path, **kw):
+    stream = analyzer.Stream(set(), path=path, sink=sinks.NullSink(), **kw)
+    stream.parse()
+
+
+def run_saver(path, out, **kw):
+    if exists(out):  # The writer appends
+        remove(out)
+    saver.parse(path=path, out=out, skipPids=(0x101,), **kw)
+
+
+def cases(path, out):
+    """Return (name, function) of every case over the file at path"""
+    return [
+        ("loop", lambda: consume(tstools.loop(path=path))),
+        ("loop mapped", lambda: consume(tstools.loop(path=path,
+                                                     mapped=True))),
+        ("store_PSI", lambda: consume(tstools.store_PSI(path=path))),
+        ("filter_PES", lambda: consume(tstools.filter_PES(path=path))),
+        ("parse_PES", lambda: consume(tstools.parse_PES(path=path))),
+        ("Stream.parse", lambda: run_stream(path)),
+        ("Stream.parse no stats", lambda: run_stream(path, stats=False)),
+        ("saver.parse", lambda: run_saver(path, out)),
+        ("saver.parse per packet", lambda: run_saver(path, out,
+                                                     coalesce=False)),
+    ]
+
+
+def bench(function, repeat=REPEAT):
+    """Return the best time of repeat runs of function"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        with redirect_stdout(StringIO()):
+            function()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def run(packets=PACKETS, repeat=REPEAT, seed=0):
+    """Benchmark every case and return the results"""
+    results = {"date": strftime("%Y-%m-%d %H:%M:%S"),
+               "python": python_version(), "packets": packets,
+               "seed": seed, "cases": {}}
+    with TemporaryDirectory() as folder:
+        path = join(folder, "synthetic.ts")
+        out = join(folder, "out.ts")
+        tsgen.generate(path, packets, seed=seed)
+        size = getsize(path)
+        for name, function in cases(path, out):
+            seconds = bench(function, repeat)
+            results["cases"][name] = {
+                "seconds": seconds, "packetsPerSecond": packets / seconds,
+                "MBps": size / seconds / 1e6}
+            print(BFMT % (name, packets / seconds, size / seconds / 1e6))
+    for size in (188, 4096):
+        speed = bench_crc32(tstools.crc32, size)
+        name = "crc32 %d bytes" % size
+        results["cases"][name] = {"MBps": speed,
+                                  "packetsPerSecond": speed * 1e6 / 188}
+        print(BFMT % (name, speed * 1e6 / 188, speed))
+    return results
+
+
+def save(results, path):
+    with open(path, "w") as f:
+        dump(results, f, indent=2)
+
+
+def compare(old, new):
+    """Print the speed of the cases of new against old (results or paths
+    to their JSON files)"""
+    if isinstance(old, str):
+        with open(old) as f:
+            old = load(f)
+    if isinstance(new, str):
+        with open(new) as f:
+            new = load(f)
+    for name, case in new["cases"].items():
+        before = old["cases"].get(name)
+        if before is None:
+            continue
+        ratio = case["MBps"] / before["MBps"]
+        line = "%-24s x%.2f" % (name, ratio)
+        print(RFMT % line if ratio < 0.95 else GFMT % line)
+
+
+def check():
+    cases, failed = check_crc32()
+    if failed:
+        print(RFMT % ("crc32: %d of %d checks failed" % (failed, cases * 3)))
+    else:
+        print(GFMT % ("crc32: %d sections match the reference" % cases))
+    wrong = check_escr()
+    if wrong:
+        print(RFMT % ("ESCR: %d values decode wrong, first %d" %
+                      (len(wrong), wrong[0])))
+    else:
+        print(GFMT % "ESCR: every value round-trips")
+    errors = check_stats_cc()
+    if errors:
+        print(RFMT % ("Stats: %d continuity errors in a clean stream" %
+                      errors))
+    else:
+        print(GFMT % "Stats: counters after packets without payload")
+    cached, uncached = check_pmt_first()
+    if cached != uncached or not cached[0]:
+        print(RFMT % ("PMT before PAT: %s with the PSI cache, %s without" %
+                      (cached, uncached)))
+    else:
+        print(GFMT % "PMT before PAT: parsed with the PSI cache")
+    first, second = check_reparse()
+    if first != second:
+        print(RFMT % ("Parse twice: %s then %s" % (first, second)))
+    else:
+        print(GFMT % "Parse twice: same tables with the PSI cache")
+    differ = check_parallel()
+    if differ:
+        print(RFMT % ("Parallel: %s differ from sequential" % differ))
+    else:
+        print(GFMT % "Parallel: same as sequential and Stream with errors")
+    found = check_vectools_sync()
+    if found is not None and found[0] != found[1]:
+        print(RFMT % ("Vectools: %s packets and bytes lost, loop %s" %
+                      (found[1], found[0])))
+    elif found is not None:
+        print(GFMT % "Vectools: same packets as loop with sync losses")
+    wrong = check_save_sizes()
+    if wrong:
+        print(RFMT % ("Saver: %s bytes packets not kept whole" % wrong))
+    else:
+        print(GFMT % "Saver: M2TS and 204 bytes packets kept whole")
+    raised = check_writer_error()
+    if len(raised) != 2:
+        print(RFMT % ("Writer: a failed write raised %s" % raised))
+    else:
+        print(GFMT % "Writer: a failed write reaches the producer")
+    wrong = check_rotation()
+    if wrong:
+        print(RFMT % ("Rotation: wrong next segments %s" % wrong))
+    else:
+        print(GFMT % "Rotation: unrelated files are not followed")
+    error = check_monitor_stopped()
+    if error is not None:
+        print(RFMT % ("Monitor: snapshot after run failed, %s" % error))
+    else:
+        print(GFMT % "Monitor: snapshot after run")
+    for size in (16, 1024, 4096):
+        slow = bench_crc32(tstools.crc32_table, size)
+        fast = bench_crc32(tstools.crc32, size)
+        print("crc32 %5d bytes: %9.2f MB/s (reference %.2f MB/s, x%.0f)" %
+              (size, fast, slow, fast / slow))
+
+
+def main(out="benchmark.json", previous=None, **kw):
+    check()
+    results = run(**kw)
+    save(results, out)
+    if previous is not None and exists(previous):
+        compare(previous, results)
+
+
+if __name__ == "__main__":
+    main()
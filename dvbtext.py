@@ -0,0 +1,83 @@
+#! python3
+from codecs import charmap_decode
+from functools import lru_cache
+import re
+from unicodedata import normalize
+
+"""
+DVB strings (SDT and EIT names and texts, ETSI EN 300 468 annex A)
+The first byte selects the character table:
+    0x20 and up: ISO 6937, the text starts right away
+    0x01 - 0x0B: ISO 8859-5 to 8859-15
+    0x10 0x00 n: ISO 8859-n
+    0x11: UCS-2 (big endian), 0x12: KS X 1001, 0x13: GB 2312, 0x14: Big5,
+    0x15: UTF-8
+Single byte tables are built once, 0x80 - 0x9F are control codes: 0x8A
+is a line break and the others (emphasis on / off...) are dropped, the
+same codes are U+E080 - U+E09F in the multi byte tables
+Names and texts repeat all the time so decoded strings are cached
+"""
+
+TEXT_CACHE = 4096  # Strings kept decoded
+UNDEFINED = "\ufffd"
+# ISO 6937 from 0xA0, the diacritics 0xC1 - 0xCF come before the letter
+ISO6937 = ("\xa0¡¢£$¥#§¤‘“«←↑→↓°±²³×µ¶·÷’”»¼½¾¿" + UNDEFINED +
+           "\u0300\u0301\u0302\u0303\u0304\u0306\u0307\u0308" +
+           UNDEFINED + "\u030a\u0327" + UNDEFINED + "\u030b\u0328\u030c" +
+           "―¹®©™♪¬¦" + UNDEFINED * 4 + "⅛⅜⅝⅞" +
+           "ΩÆĐªĦ" + UNDEFINED + "ĲĿŁØŒºÞŦŊŉ" +
+           "ĸæđðħıĳŀłøœßþŧŋ\xad")
+DIACRITIC = re.compile("([\u0300-\u030c\u0327\u0328])(.)", re.S)
+ISO8859 = dict(enumerate((5, 6, 7, 8, 9, 10, 11, None, 13, 14, 15), 1))
+MULTI_BYTE = {0x11: "utf-16-be", 0x12: "euc_kr", 0x13: "gb2312",
+              0x14: "big5", 0x15: "utf-8"}
+CONTROLS = dict((c, None) for c in range(0x80, 0xA0))
+CONTROLS.update((c, None) for c in range(0xE080, 0xE0A0))
+CONTROLS.update({0x8A: "\n", 0xE08A: "\n"})
+
+
+def single_byte_table(codec):
+    """Return the 256 characters of a single byte table"""
+    if codec == "iso6937":
+        table = "".join(map(chr, range(0xA0))) + ISO6937
+    else:
+        table = bytes(range(256)).decode(codec, "replace")
+    return table[:0x80] + "".join(map(chr, range(0x80, 0xA0))) + table[0xA0:]
+
+
+TABLES = dict((n, single_byte_table("iso8859-%d" % n))
+              for n in range(1, 17) if n != 12)
+TABLES[0] = single_byte_table("iso6937")
+
+
+def table_of(b):
+    """Return (single byte table or codec name, text start) of b"""
+    first = b[0]
+    if first >= 0x20:
+        return TABLES[0], 0
+    if first in ISO8859:
+        return TABLES.get(ISO8859[first]), 1
+    if first == 0x10 and len(b) >= 3:
+        return TABLES.get(b[2]), 3
+    return MULTI_BYTE.get(first), 1
+
+
+@lru_cache(maxsize=TEXT_CACHE)
+def decode_bytes(b):
+    if not b:
+        return ""
+    table, start = table_of(b)
+    if table is None:  # Reserved or unknown selector
+        return b[start:].decode("latin-1").translate(CONTROLS)
+    if len(table) == 256:
+        text = charmap_decode(b[start:], "replace", table)[0]
+        if table is TABLES[0] and DIACRITIC.search(text):
+            text = normalize("NFC", DIACRITIC.sub(r"\2\1", text))
+    else:
+        text = b[start:].decode(table, "replace")
+    return text.translate(CONTROLS)
+
+
+def decode(b):
+    """Return the DVB string b (bytes or memoryview) as a str"""
+    return decode_bytes(bytes(b))
@@ -0,0 +1,159 @@
+#! python3
+from collections import OrderedDict
+from heapq import heapify, heappop, heappush
+import dvbtext
+import tstools
+
+"""
+EPG built from the EIT sections, bounded in memory:
+    Events keep their raw bytes and are decoded only when read
+    Sections are merged by (service, table, section number), a section
+    seen again with the same version is skipped and a new version
+    replaces the events it listed
+    Events that ended before the stream time (TDT) are evicted, and past
+    EPG_MAX events the least recently updated ones go first
+NVOD reference events have undefined times (0xFF): start and end are -1
+and they are never evicted by time
+"""
+
+EPG_MAX = 20000  # Events kept
+
+
+class Event():
+    """An EIT event, its texts are decoded on the first access"""
+    __slots__ = ("serviceId", "eventId", "version", "start", "end",
+                 "running", "raw", "decoded")
+
+    def __init__(self, serviceId, eventId, version, raw):
+        self.serviceId = serviceId
+        self.eventId = eventId
+        self.version = version
+        self.raw = raw  # start_time, duration and descriptors
+        self.running = (raw[8] & 0xE0) >> 5
+        try:
+            self.start = tstools.parse_utc(raw[:5])
+            self.end = self.start + tstools.parse_seconds(raw[5:8])
+        except ValueError:  # Undefined times (0xFF) of NVOD events
+            self.start = self.end = -1
+        self.decoded = None
+
+    def descriptors(self):
+        length = ((self.raw[8] & 0x0F) << 8) + self.raw[9]
+        return tstools.parse_descriptors(self.raw[10:], length)[1]
+
+    def times(self):
+        """Return (date, hour, duration) as tuples, None if undefined"""
+        if self.start < 0:
+            return None
+        raw = self.raw
+        return (tstools.parse_mjd(raw), tstools.parse_bcd(raw[2:]),
+                tstools.parse_bcd(raw[5:]))
+
+    def decode(self):
+        """Return the texts of the event as a dict, decoding them once
+        date, hour and duration are None if the times are undefined"""
+        if self.decoded is not None:
+            return self.decoded
+        date, hour, duration = self.times() or (None, None, None)
+        event = {"info": "", "extended": "", "date": date, "hour": hour,
+                 "duration": duration, "streams": []}
+        for dTag, dData in self.descriptors():
+            if dTag == 77:  # Info
+                lang = dvbtext.decode(dData[:3])
+                _length = dData[3]
+                eventName = dvbtext.decode(dData[4:_length + 4])
+                text = dvbtext.decode(dData[_length + 5:])
+                event["info"] = ";".join((lang, eventName, text))
+            elif dTag == 78:  # Extended
+                number = (dData[0] & 0xF0) >> 4
+                lang = dvbtext.decode(dData[1:4])
+                offset = dData[4] + 6
+                text = dvbtext.decode(dData[offset:])
+                if number == 0:
+                    t = ";".join((lang, text))
+                    event["extended"] = t + event["extended"]
+                else:
+                    event["extended"] += text
+            elif dTag == 80:  # Component
+                content = dData[0] & 0x0F
+                lang = dvbtext.decode(dData[3:6])
+                event["streams"].append((lang, content))
+        self.decoded = event
+        return event
+
+
+class Epg():
+    def __init__(self, maxEvents=EPG_MAX):
+        self.maxEvents = maxEvents
+        self.events = OrderedDict()  # (serviceId, eventId) -> Event
+        # Heap of (end, (serviceId, eventId)), replaced events stay in it
+        # until they are popped or it is rebuilt
+        self.ends = []
+        self.sections = {}  # (serviceId, tableId, section) -> (v, keys)
+        self.now = -1  # Stream time (unix), from the TDT
+        self.skipped = 0  # Sections already seen
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    def add_section(self, serviceId, tableId, version, number, data):
+        """Merge the event loop data of an EIT section
+        Return the events parsed, empty if the section was already seen"""
+        key = (serviceId, tableId, number)
+        old = self.sections.get(key)
+        if old is not None and old[0] == version:
+            self.skipped += 1
+            return []
+        events = self.events
+        parsed = []
+        while len(data) >= 12:
+            length = ((data[10] & 0x0F) << 8) + data[11] + 12
+            eventId = (data[0] << 8) + data[1]
+            eventKey = (serviceId, eventId)
+            raw = bytes(data[2:length])
+            event = events.get(eventKey)
+            if event is None or event.raw != raw:
+                event = Event(serviceId, eventId, version, raw)
+                events[eventKey] = event
+                if event.end >= 0:
+                    heappush(self.ends, (event.end, eventKey))
+            events.move_to_end(eventKey)
+            parsed.append(event)
+            data = data[length:]
+        keys = tuple((serviceId, e.eventId) for e in parsed)
+        if old is not None:  # Events gone from the new version
+            for eventKey in set(old[1]).difference(keys):
+                events.pop(eventKey, None)
+        self.sections[key] = (version, keys)
+        while len(events) > self.maxEvents:
+            events.popitem(last=False)
+            self.evicted += 1
+        if len(self.ends) > 2 * len(events) + 64:  # Mostly replaced ones
+            self.ends = [(e.end, k) for k, e in events.items() if e.end >= 0]
+            heapify(self.ends)
+        return parsed
+
+    def set_time(self, now):
+        """Move the stream time to now (unix) and drop the past events
+        (only the ones that ended are looked at)"""
+        self.now = now
+        events = self.events
+        ends = self.ends
+        while ends and ends[0][0] < now:
+            eventKey = heappop(ends)[1]
+            event = events.get(eventKey)
+            if event is not None and 0 <= event.end < now:
+                del events[eventKey]
+                self.evicted += 1
+
+    def service(self, serviceId):
+        """Return the events of serviceId sorted by start time"""
+        return sorted((e for (s, _), e in self.events.items()
+                       if s == serviceId), key=lambda e: e.start)
+
+    def as_dict(self):
+        """Return {serviceId: [decoded events]}"""
+        services = sorted(set(s for s, _ in self.events))
+        return dict((s, [e.decode() for e in self.service(s)])
+                    for s in services)
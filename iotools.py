@@ -1,19 +1,163 @@
 #! python3
+import os
+import re
 import socket
+from ipaddress import ip_address
+from mmap import mmap, ACCESS_READ
 from struct import pack
-from threading import Thread
+from threading import Thread, Lock, Condition
+from time import monotonic, perf_counter, sleep
 from collections import deque
+from itertools import count, islice
 
+RCVBUF = 8 << 20  # Bytes asked for the kernel receive buffer
+DATAGRAM_MAX = 1 << 16
+UDP_BLOCK = 1 << 20  # Bytes of datagrams received into one buffer
+UDP_RING = 4  # Buffers an UdpSource receives into in turn
+WRITER_QUEUE = 1 << 16  # Items waiting in a Writer before put() blocks
+IOV_MAX = 1024  # Buffers per writev call
+SEND_SLACK = 0.0005  # Seconds a paced datagram can go early or late
+POLL = 0.5  # Seconds between checks of a followed file that did not grow
+# Numbers of a segment name that change with the rotation: dates, times
+# and counters, not the ones glued after letters (RGE1) but a counter
+# right before the extension (capture001.ts)
+ROTATING = re.compile(r"(?<![A-Za-z])\d+|\d+(?=\.[^.]*$)")
 
-def read_file(path):
-    """Read from a ts file at path"""
+
+def read_file(path, offset=0):
+    """Read from a ts file at path, starting at byte offset"""
     def wrapper(n):
         return f_read(n)
     f = open(path, "rb")
+    f.seek(offset)
     f_read = f.read
     return wrapper
 
 
+class MappedFile():
+    """Memory map of a ts file at path seen as a sequence of packets
+    Every packet and block is a memoryview of the map, nothing is copied"""
+    def __init__(self, path, size=188):
+        self.size = size
+        with open(path, "rb") as f:
+            try:
+                data = mmap(f.fileno(), 0, access=ACCESS_READ)
+            except ValueError:  # Empty files can not be mapped
+                data = b""
+        self.data = data  # The whole map, a cut packet at the end too
+        self.count = len(data) // size
+        self.view = memoryview(data)[:self.count * size]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("Packet %d out of range" % index)
+        size = self.size
+        return self.view[index * size:(index + 1) * size]
+
+    def blocks(self, start=0, block=1024):
+        """Yield views of block packets each, starting at packet start"""
+        view = self.view
+        step = block * self.size
+        for i in range(start * self.size, len(view), step):
+            yield view[i:i + step]
+
+
+def read_blocks(read, size):
+    """Yield blocks of up to size bytes from read until it runs dry"""
+    while True:
+        data = read(size)
+        if not data:
+            break
+        yield data
+
+
+def rotation(name):
+    """Return the pattern of the names of the segments rotating with
+    name, its ROTATING numbers are the groups, None if it has none"""
+    parts = ROTATING.split(name)
+    if len(parts) == 1:
+        return None
+    return re.compile(r"(\d+)".join(map(re.escape, parts)))
+
+
+def rotation_key(pattern, name):
+    """Order of name in the rotation of pattern, None if not in it"""
+    match = pattern.fullmatch(name)
+    return tuple(map(int, match.groups())) if match else None
+
+
+class Follower():
+    """Read a capture that is still being written, like tail -f
+    At the end of the file it waits for more data, and when a later
+    segment of its rotation appears (same name but for the dates, times
+    and counters, see ROTATING) the rest of the file is read and the
+    next one is opened
+    Stops after idle seconds without new data (never if None)
+    path and offset always tell where the next read starts"""
+    def __init__(self, path, offset=0, poll=POLL, idle=None, rotate=True):
+        self.path = path
+        self.offset = offset
+        self.poll = poll
+        self.idle = idle
+        self.rotate = rotate
+        self.pattern = rotation(os.path.basename(path))
+        self.segments = 1  # Files read
+
+    def next_segment(self):
+        """Return the path of the segment after the current one, if any"""
+        if self.pattern is None:
+            return None
+        folder, name = os.path.split(self.path)
+        current = rotation_key(self.pattern, name)
+        later = []
+        for n in os.listdir(folder or "."):
+            key = rotation_key(self.pattern, n)
+            if key is not None and key > current:
+                later.append((key, n))
+        return os.path.join(folder, min(later)[1]) if later else None
+
+    def blocks(self, size):
+        """Yield blocks of up to size bytes as the files grow"""
+        f = open(self.path, "rb")
+        f.seek(self.offset)
+        last = monotonic()
+        try:
+            while True:
+                data = f.read(size)
+                if data:
+                    self.offset += len(data)
+                    last = monotonic()
+                    yield data
+                    continue
+                following = self.next_segment() if self.rotate else None
+                if following is not None:
+                    data = f.read()  # Written before the rotation
+                    if data:
+                        self.offset += len(data)
+                        yield data
+                    f.close()
+                    f = open(following, "rb")
+                    self.path = following
+                    self.offset = 0
+                    self.segments += 1
+                    last = monotonic()
+                elif self.idle is not None and monotonic() - last >= self.idle:
+                    break
+                else:
+                    sleep(self.poll)
+        finally:
+            f.close()
+
+    def stats(self):
+        return {"path": self.path, "offset": self.offset,
+                "segments": self.segments}
+
+
 def read_udp(ip, port):
     """Read from udp://ip:port"""
     def wrapper(n):
@@ -27,24 +171,162 @@ def read_udp(ip, port):
     return wrapper
 
 
+def udp_socket(ip, port, rcvbuf=RCVBUF):
+    """Return an udp socket bound to ip:port, joined if it is multicast"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    s.bind((ip, port))
+    if ip_address(ip).is_multicast:
+        request = pack("4sl", socket.inet_aton(ip), socket.INADDR_ANY)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, request)
+    return s
+
+
+def rtp_header(data, start=0):
+    """Return the length and sequence number of the RTP header at start"""
+    b0 = data[start]
+    header = 12 + 4 * (b0 & 0x0F)
+    if b0 & 0x10:  # Extension
+        header += 4 + 4 * ((data[start + header + 2] << 8) +
+                           data[start + header + 3])
+    return (header, (data[start + 2] << 8) + data[start + 3])
+
+
+def is_rtp(data, start=0, n=None):
+    """True if the datagram at start looks like RTP instead of plain TS"""
+    n = len(data) - start if n is None else n
+    return bool(n % 188) and data[start] & 0xC0 == 0x80
+
+
+def udp_queue(s):
+    """Return (bytes queued, datagrams dropped) by the kernel for the
+    socket s, read from /proc (Linux only, None otherwise or once s is
+    closed)"""
+    if s.fileno() == -1:
+        return None
+    try:
+        inode = str(os.fstat(s.fileno()).st_ino)
+        with open("/proc/net/udp") as f:
+            for line in f:
+                fields = line.split()
+                if fields[9] == inode:
+                    return (int(fields[4].split(":")[1], 16), int(fields[-1]))
+    except OSError:
+        pass
+    return None
+
+
+class UdpSource():
+    """Receive udp://ip:port (joining it if it is multicast)
+    Datagrams are received with recv_into straight into large buffers, as
+    many as are queued at once, so each block holds a batch of them and
+    no datagram is cut. RTP headers are removed and their gaps counted
+    The buffers are used in turn and reused once no view of them is left
+    (when the consumer kept one, that buffer is replaced)"""
+    def __init__(self, ip, port, rcvbuf=RCVBUF, block=UDP_BLOCK):
+        s = udp_socket(ip, port, rcvbuf)
+        self.socket = s
+        self.block = max(block, DATAGRAM_MAX)
+        self.rcvbuf = s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self.datagrams = 0
+        self.bytes = 0
+        self.batches = 0
+        self.rtpLost = 0
+        self.rtpSequence = -1
+        self.ring = [None] * UDP_RING
+        self.allocations = 0  # Buffers allocated
+
+    def buffer(self, i):
+        """Return the buffer i of the ring, a new one if it is still seen"""
+        buffer = self.ring[i]
+        if buffer is not None:
+            try:  # A bytearray can only be resized once nothing views it
+                buffer.append(0)
+                del buffer[-1]
+                return buffer
+            except BufferError:
+                pass
+        buffer = self.ring[i] = bytearray(self.block)
+        self.allocations += 1
+        return buffer
+
+    def strip_rtp(self, buffer, start, n):
+        """Remove the RTP header of the datagram at start, return its size"""
+        header, sequence = rtp_header(buffer, start)
+        if self.rtpSequence != -1:
+            self.rtpLost += (sequence - self.rtpSequence - 1) & 0xFFFF
+        self.rtpSequence = sequence
+        buffer[start:start + n - header] = buffer[start + header:start + n]
+        return n - header
+
+    def blocks(self):
+        """Yield views of the batches of datagrams received"""
+        recv_into = self.socket.recv_into
+        dontWait = getattr(socket, "MSG_DONTWAIT", 0)
+        block = self.block
+        for i in count():
+            buffer = self.buffer(i % UDP_RING)
+            view = memoryview(buffer)
+            filled = 0
+            flags = 0
+            while block - filled >= DATAGRAM_MAX:
+                try:
+                    n = recv_into(view[filled:], DATAGRAM_MAX, flags)
+                except BlockingIOError:
+                    break
+                if is_rtp(buffer, filled, n):
+                    n = self.strip_rtp(buffer, filled, n)
+                self.datagrams += 1
+                filled += n
+                if not dontWait:  # One datagram at a time
+                    break
+                flags = dontWait
+            self.bytes += filled
+            self.batches += 1
+            yield view[:filled]
+
+    def stats(self):
+        kernel = udp_queue(self.socket) or (None, None)
+        return {"datagrams": self.datagrams, "bytes": self.bytes,
+                "batches": self.batches, "rtpLost": self.rtpLost,
+                "allocations": self.allocations,
+                "rcvbuf": self.rcvbuf, "queued": kernel[0],
+                "dropped": kernel[1]}
+
+    def close(self):
+        self.socket.close()
+
+
 def write_file(path):
-    """Write to a ts file at path"""
+    """Write to a ts file at path, kept open"""
     def wrapper(data):
-        with open(path, "ab") as f:
-            f.write(data)
+        f_write(data)
+    f = open(path, "ab")
+    f_write = f.write
+    wrapper.close = f.close
     return (wrapper, "simple")
 
 
 def write_file_queue(path):
-    """Write to a ts file at path locking it until it finishes"""
-    def wrapper(queue):
-        f = open(path, "ab")
-        f_write = f.write
-        queue_popleft = queue.popleft
-        for i in queue.copy():
-            f_write(i)
-            queue_popleft()
-        f.close()
+    """Write batches (lists) of data to a ts file at path, kept open
+    Each batch goes in as few writev calls as possible"""
+    def wrapper(batch):
+        for i in range(0, len(batch), IOV_MAX):
+            chunk = batch[i:i + IOV_MAX]
+            done = f_writev(chunk)
+            if done < sum(map(len, chunk)):  # Short write
+                f.write(b"".join(chunk)[done:])
+    f = open(path, "ab", buffering=0)
+    if hasattr(os, "writev"):
+        fd = f.fileno()
+
+        def f_writev(chunk):
+            return os.writev(fd, chunk)
+    else:
+        def f_writev(chunk):
+            return f.write(b"".join(chunk))
+    wrapper.close = f.close
     return (wrapper, "complex")
 
 
@@ -56,39 +338,154 @@ def write_udp(ip, port):
     s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
     pair = (ip, port)
     s_sendto = s.sendto
+    wrapper.close = s.close
     return (wrapper, "simple")
 
 
+class PacedUdp():
+    """Send datagrams to udp://ip:port, each one at a given time
+    Datagrams are gathered from a list of buffers (no joining) and the
+    ones already due go out back to back without sleeping in between"""
+    def __init__(self, ip, port, ttl=2, slack=SEND_SLACK):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                          socket.IPPROTO_UDP)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.socket = s
+        self.pair = (ip, port)
+        self.slack = slack
+        self.datagrams = 0
+        self.bytes = 0
+        self.late = 0  # Datagrams sent more than slack after their time
+        self.maxLate = 0.0
+
+    def send(self, buffers, at):
+        """Send buffers as one datagram at the perf_counter() time at"""
+        delay = at - perf_counter()
+        if delay > self.slack:
+            sleep(delay)
+        elif delay < -self.slack:
+            self.late += 1
+            self.maxLate = max(self.maxLate, -delay)
+        if hasattr(self.socket, "sendmsg"):
+            self.bytes += self.socket.sendmsg(buffers, (), 0, self.pair)
+        else:
+            self.bytes += self.socket.sendto(b"".join(buffers), self.pair)
+        self.datagrams += 1
+
+    def stats(self):
+        return {"datagrams": self.datagrams, "bytes": self.bytes,
+                "late": self.late, "maxLate": self.maxLate}
+
+    def close(self):
+        self.socket.close()
+
+
 class Writer():
-    def __init__(self, write):
+    """Write what is put in a bounded queue from a thread
+    "simple" writes get one item at a time, "complex" ones a list with
+    everything queued since the last write. put() blocks while the queue
+    is full, so a slow output slows down the producer. If a write fails
+    the thread stops and the error is raised to the producer by put(),
+    put_many() (at the latest once the queue is full) and stop()"""
+    def __init__(self, write, maxQueue=WRITER_QUEUE, metrics=None):
         self.on = True
         self.queue = deque()
+        self.maxQueue = maxQueue
+        lock = Lock()
+        self.notEmpty = Condition(lock)
+        self.notFull = Condition(lock)
+        self.written = 0  # Items
+        self.bytes = 0
+        self.batches = 0
+        self.waits = 0  # Times put() had to wait for room
+        self.error = None  # What a write raised, the thread is gone
+        self.started = monotonic()
         self.thread = Thread(target=self.loop, daemon=True)
         self.writeArgs = write
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.collect("writer", self.stats)
         self.thread.start()
 
+    def put(self, data):
+        """Queue data, waiting while the queue is full"""
+        queue = self.queue
+        with self.notFull:
+            while len(queue) >= self.maxQueue:
+                if self.error is not None:
+                    raise self.error
+                self.waits += 1
+                self.notFull.wait()
+            queue.append(data)
+            if len(queue) == 1:
+                self.notEmpty.notify()
+
+    def put_many(self, items):
+        """Queue every item in items, they are taken from items a queue
+        size at a time outside the lock, so the writer thread is not held
+        while a generator makes them"""
+        items = iter(items)
+        queue = self.queue
+        while True:
+            chunk = list(islice(items, self.maxQueue))
+            if not chunk:
+                break
+            with self.notFull:
+                while len(queue) + len(chunk) > self.maxQueue:
+                    if self.error is not None:
+                        raise self.error
+                    self.waits += 1
+                    self.notEmpty.notify()
+                    self.notFull.wait()
+                queue.extend(chunk)
+                self.notEmpty.notify()
+
     def loop(self):
         queue = self.queue
-        queue_copy = queue.copy
-        queue_popleft = queue.popleft
         write, name = self.writeArgs
-        if name == "simple":
-            while self.on:
-                for i in queue_copy():
-                    f_write(i)
-                    queue_popleft()
-        elif name == "complex":
-            while self.on:
-                write(queue)
+        if self.metrics is not None:
+            write = self.metrics.timed("write", write)
+        while True:
+            with self.notEmpty:
+                while self.on and not queue:
+                    self.notEmpty.wait()
+                if not queue:  # Stopped and empty
+                    break
+                batch = list(queue)
+                queue.clear()
+                self.notFull.notify_all()
+            try:
+                if name == "simple":
+                    for i in batch:
+                        write(i)
+                elif name == "complex":
+                    write(batch)
+            except Exception as e:  # Disk full, broken pipe...
+                with self.notFull:
+                    self.error = e
+                    self.on = False
+                    self.notFull.notify_all()
+                break
+            self.written += len(batch)
+            self.bytes += sum(map(len, batch))
+            self.batches += 1
+        close = getattr(self.writeArgs[0], "close", None)  # Not timed
+        if close is not None:
+            close()
         print("Exited the loop")
-        if name == "simple":
-            for i in queue_copy():
-                f_write(i)
-                queue_popleft()
-        elif name == "complex":
-            write(queue)
+
+    def stats(self):
+        elapsed = monotonic() - self.started
+        return {"queued": len(self.queue), "written": self.written,
+                "bytes": self.bytes, "batches": self.batches,
+                "waits": self.waits,
+                "MBps": self.bytes / elapsed / 1e6 if elapsed else 0}
 
     def stop(self):
-        self.on = False
+        with self.notEmpty:
+            self.on = False
+            self.notEmpty.notify()
         self.thread.join()
         print("Finished writing")
+        if self.error is not None:
+            raise self.error
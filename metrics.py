@@ -0,0 +1,179 @@
+#! python3
+import os
+import re
+import sys
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Event, get_ident
+from time import perf_counter
+
+"""
+Optional instrumentation of the hot paths. Nothing here is imported or
+called unless a Metrics is given (metrics=...) to tstools.loop(),
+analyzer.Stream or iotools.Writer: they then wrap their stages with
+timed() / timed_iter() instead of checking a flag on every packet.
+Stage times are inclusive (payload contains psi, psi contains crc).
+Exporter writes them in the Prometheus text format to a file and/or
+serves them over HTTP, Sampler is an opt-in sampling profiler
+"""
+
+PREFIX = "ts"
+INTERVAL = 10  # Seconds between exports
+SAMPLE = 0.005  # Seconds between profiler samples
+TOP = 20  # Functions exported by the profiler
+
+
+class Metrics():
+    def __init__(self):
+        self.timers = {}  # stage -> [calls, seconds]
+        self.counters = Counter()
+        self.collectors = {}  # name -> function returning {key: number}
+
+    def timer(self, stage):
+        return self.timers.setdefault(stage, [0, 0.0])
+
+    def timed(self, stage, function):
+        """Return function timed as stage"""
+        timer = self.timer(stage)
+
+        def wrapper(*args):
+            start = perf_counter()
+            try:
+                return function(*args)
+            finally:
+                timer[0] += 1
+                timer[1] += perf_counter() - start
+        return wrapper
+
+    def timed_iter(self, stage, iterable):
+        """Yield the items of iterable timing how long each one takes"""
+        timer = self.timer(stage)
+        iterator = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            timer[0] += 1
+            timer[1] += perf_counter() - start
+            yield item
+
+    def counted(self, name, iterable):
+        """Yield the items of iterable counting them as name"""
+        counters = self.counters
+        n = 0
+        for n, item in enumerate(iterable, 1):
+            if not n & 0x3FF:
+                counters[name] += 1024
+            yield item
+        counters[name] += n & 0x3FF
+
+    def collect(self, name, function):
+        """Export the numbers of function() as gauges name_key"""
+        self.collectors[name] = function
+
+    def prometheus(self):
+        """Return every metric in the Prometheus text format"""
+        lines = ["# TYPE %s_stage_calls_total counter" % PREFIX,
+                 "# TYPE %s_stage_seconds_total counter" % PREFIX]
+        for stage, (calls, seconds) in sorted(self.timers.items()):
+            lines.append('%s_stage_calls_total{stage="%s"} %d' %
+                         (PREFIX, stage, calls))
+            lines.append('%s_stage_seconds_total{stage="%s"} %.6f' %
+                         (PREFIX, stage, seconds))
+        for name, n in sorted(self.counters.items()):
+            lines.append("# TYPE %s_%s_total counter" % (PREFIX, name))
+            lines.append("%s_%s_total %d" % (PREFIX, name, n))
+        for name, function in sorted(self.collectors.items()):
+            for key, value in sorted(function().items()):
+                if isinstance(value, (int, float)):
+                    key = re.sub(r"\W", "_", key)
+                    lines.append("%s_%s_%s %s" % (PREFIX, name, key, value))
+        lines.append("")
+        return "\n".join(lines)
+
+
+class Exporter():
+    """Write the metrics to path every interval seconds (replacing the
+    file at once) and/or serve them on http://host:port/metrics"""
+    def __init__(self, metrics, path=None, port=None, host="127.0.0.1",
+                 interval=INTERVAL):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = Event()
+        self.server = None
+        if port is not None:
+            self.server = ThreadingHTTPServer((host, port), self.handler())
+            self.server.daemon_threads = True
+            Thread(target=self.server.serve_forever, daemon=True).start()
+        if path is not None:
+            Thread(target=self.loop, daemon=True).start()
+
+    def handler(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        return Handler
+
+    def write(self):
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(self.metrics.prometheus())
+        os.replace(temporary, self.path)
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self.stopped.set()
+        if self.path is not None:
+            self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class Sampler():
+    """Sample the function running in a thread (the calling one by
+    default) every interval seconds, exported as profile_<function>"""
+    def __init__(self, metrics, thread=None, interval=SAMPLE, top=TOP):
+        self.samples = Counter()
+        self.thread = thread or get_ident()
+        self.interval = interval
+        self.top = top
+        self.stopped = Event()
+        metrics.collect("profile", self.most_common)
+        Thread(target=self.loop, daemon=True).start()
+
+    def loop(self):
+        samples = self.samples
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread)
+            if frame is None:
+                break
+            code = frame.f_code
+            name = os.path.basename(code.co_filename).split(".")[0]
+            samples["%s_%s" % (name, code.co_name)] += 1
+
+    def most_common(self):
+        return dict(self.samples.most_common(self.top))
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,152 @@
+#! python3
+import asyncio
+from collections import deque
+from time import monotonic
+import analyzer
+import iotools
+import sinks
+import tstools
+
+QUEUE = 1024  # Datagrams waiting per group, more are dropped
+BATCH = 64  # Datagrams parsed before letting the other groups run
+INTERVAL = 10  # Seconds between stats snapshots
+SFMT = ("%s: %.2f Mbit/s, %d datagrams, %d dropped, %d queued, "
+        "%d bytes out of sync, %d services")
+
+
+class Group(asyncio.DatagramProtocol):
+    """An udp/multicast group parsed by its own analyzer.Stream
+    Datagrams wait in a bounded queue until the group gets its turn, when
+    the queue is full new ones are dropped (and counted) so a slow group
+    does not hold the others back"""
+    def __init__(self, ip, port, queue=QUEUE, skipPids=None, **kw):
+        self.ip = ip
+        self.port = port
+        self.name = "%s:%d" % (ip, port)
+        self.queue = deque()
+        self.queueMax = queue
+        self.ready = asyncio.Event()
+        kw.setdefault("sink", sinks.NullSink())
+        self.stream = analyzer.Stream(set(skipPids or ()), **kw)
+        self.stream.reset()
+        self.sync = self.stream.sync
+        self.socket = None
+        self.datagrams = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.rtpLost = 0
+        self.rtpSequence = -1
+
+    def datagram_received(self, data, addr):
+        if len(self.queue) >= self.queueMax:
+            self.dropped += 1
+            return
+        self.queue.append(data)
+        self.ready.set()
+
+    def parse(self, data):
+        if iotools.is_rtp(data):
+            header, sequence = iotools.rtp_header(data)
+            if self.rtpSequence != -1:
+                self.rtpLost += (sequence - self.rtpSequence - 1) & 0xFFFF
+            self.rtpSequence = sequence
+            data = memoryview(data)[header:]
+        self.datagrams += 1
+        self.bytes += len(data)
+        self.stream.feed(tstools.walk((data,), (), self.sync))
+
+    async def consume(self):
+        """Parse the queued datagrams BATCH at a time"""
+        queue = self.queue
+        queue_popleft = queue.popleft
+        parse = self.parse
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while queue:
+                for _ in range(min(BATCH, len(queue))):
+                    parse(queue_popleft())
+                await asyncio.sleep(0)
+
+    def snapshot(self):
+        """Return the counters of the group"""
+        stream = self.stream
+        kernel = None
+        if self.socket is not None:
+            kernel = iotools.udp_queue(self.socket)
+        return {"group": self.name, "datagrams": self.datagrams,
+                "bytes": self.bytes, "dropped": self.dropped,
+                "queued": len(self.queue), "rtpLost": self.rtpLost,
+                "kernel": kernel, "syncLost": self.sync.lost,
+                "programs": len(stream.pat), "services": len(stream.sdt),
+                "time": monotonic()}
+
+
+def show_stats(snapshots, previous):
+    for s in snapshots:
+        last = previous.get(s["group"])
+        rate = 0
+        if last is not None and s["time"] > last["time"]:
+            rate = ((s["bytes"] - last["bytes"]) * 8 /
+                    (s["time"] - last["time"]) / 1e6)
+        print(SFMT % (s["group"], rate, s["datagrams"], s["dropped"],
+                      s["queued"], s["syncLost"], s["services"]))
+
+
+class Monitor():
+    """Monitor many udp/multicast groups from one asyncio event loop
+    groups is a list of (ip, port), the rest of kw goes to every Group
+    onStats(snapshots, previous) is called every interval seconds"""
+    def __init__(self, groups, interval=INTERVAL, onStats=show_stats,
+                 rcvbuf=iotools.RCVBUF, **kw):
+        self.groups = [Group(ip, port, **kw) for ip, port in groups]
+        self.interval = interval
+        self.onStats = onStats
+        self.rcvbuf = rcvbuf
+
+    def snapshot(self):
+        return [g.snapshot() for g in self.groups]
+
+    async def report(self):
+        previous = {}
+        while True:
+            await asyncio.sleep(self.interval)
+            snapshots = self.snapshot()
+            self.onStats(snapshots, previous)
+            previous = dict((s["group"], s) for s in snapshots)
+
+    async def run(self, duration=None):
+        """Receive and parse every group, for duration seconds or forever"""
+        loop = asyncio.get_running_loop()
+        transports = []
+        tasks = []
+        try:
+            for group in self.groups:
+                group.socket = iotools.udp_socket(group.ip, group.port,
+                                                  self.rcvbuf)
+                transport, _ = await loop.create_datagram_endpoint(
+                    lambda group=group: group, sock=group.socket)
+                transports.append(transport)
+                tasks.append(asyncio.create_task(group.consume()))
+            if self.onStats is not None:
+                tasks.append(asyncio.create_task(self.report()))
+            if duration is None:
+                await asyncio.gather(*tasks)
+            else:
+                await asyncio.sleep(duration)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for transport in transports:
+                transport.close()
+
+
+def main(groups, **kw):
+    try:
+        asyncio.run(Monitor(groups, **kw).run())
+    except KeyboardInterrupt:
+        print(analyzer.RFMT % "Keyboard Interrupt")
+
+
+if __name__ == "__main__":
+    main([("239.0.0.%d" % i, 1234) for i in range(1, 9)])
@@ -0,0 +1,295 @@
+#! python3
+from pprint import pprint
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+import iotools
+import tstools
+
+"""
+A file is cut on sync points into chunks analyzed in a process pool
+Each chunk keeps per PID state as if it was the start of the stream plus
+what is needed to stitch it to the previous chunk:
+    first continuity counter, first PCR and the payloads that continue a
+    section started before the chunk (head), and the partial sections
+    left at its end (tail)
+merge() replays those boundaries in order, so the result is the same one
+a single sequential pass over the whole file gives (only 188 bytes
+packets). A chunk starts in the middle of 2 * SYNC_CHECKS packets in
+sync (see cut_point), where the sequential walk is in sync too whatever
+it went through before, and it walks into the next chunk (LOOKAHEAD)
+to resync like the sequential walk would
+"""
+
+PCR_MAX_INTERVAL = 27000 * 100  # 100ms, ETR 290 PCR repetition limit
+LOOKAHEAD = 188 * tstools.SYNC_CHECKS  # Bytes read past a chunk
+SPLIT_WINDOW = 1 << 20  # Bytes searched for a sync point after a cut
+
+
+class Chunk():
+    """State of the analysis of the bytes [start, stop) of a file"""
+    def __init__(self, start=0, stop=0):
+        self.start = start
+        self.stop = stop
+        self.packets = {}  # pid -> packets
+        # pid -> (counter, payload, discontinuity indicator) of its first
+        # packet and counter of its last one, not for the stuffing
+        self.first = {}
+        self.lastCounter = {}
+        self.ccErrors = {}
+        self.pcrFirst = {}
+        self.pcrLast = {}
+        self.pcrCount = {}
+        self.pcrMax = {}  # pid -> longest interval between PCRs
+        self.pcrErrors = {}  # pid -> intervals over PCR_MAX_INTERVAL
+        # Packet indexes are counted from the start of the chunk
+        self.sections = []  # (packet index, pid, section)
+        self.head = {}  # pid -> [(packet index, payload)] before a PUSI
+        self.tail = {}  # pid -> (partial section, its length)
+        self.lost = 0
+
+
+def add(d, key, n=1):
+    d[key] = d.get(key, 0) + n
+
+
+def pcr_interval(chunk, pid, pcr):
+    """Account the interval between the last PCR of pid and pcr"""
+    interval = pcr - chunk.pcrLast[pid]
+    if interval > chunk.pcrMax.get(pid, 0):
+        chunk.pcrMax[pid] = interval
+    if not 0 <= interval <= PCR_MAX_INTERVAL:
+        add(chunk.pcrErrors, pid)
+
+
+def analyze_chunk(path, start, stop):
+    """Analyze the bytes [start, stop) of the ts file at path"""
+    chunk = Chunk(start, stop)
+    packets = chunk.packets
+    first = chunk.first
+    lastCounter = chunk.lastCounter
+    ccErrors = chunk.ccErrors
+    pcrLast = chunk.pcrLast
+    head = chunk.head
+    headSize = {}
+    opened = set()  # PIDs that had a PUSI in the chunk
+    sections = tstools.Sections()
+    feed = sections.feed
+    sections_append = chunk.sections.append
+    sync = tstools.Sync(188)
+    blocks = bounded(memoryview(iotools.MappedFile(path).data), start, stop)
+    walked = 0  # Bytes of the packets, skipped ones are in sync.lost
+    for i, packet in enumerate(tstools.walk(blocks, (), sync)):
+        if start + walked + sync.lost >= stop:  # Start of the next chunk
+            break
+        walked += sync.size
+        pid = ((packet[1] & 0x1F) << 8) + packet[2]
+        add(packets, pid)
+        flags = packet[3]
+        counter = flags & 0x0F
+        pF = flags & 0x10
+        # Continuity, the rule of the stats of analyzer.Stream: the
+        # counter of the last packet again (a duplicate or a packet after
+        # one without payload) and the discontinuity indicator are fine
+        if pid != 8191:
+            last = lastCounter.get(pid)
+            if last is None:
+                first[pid] = (counter, pF, flags & 0x20 and packet[4] and
+                              packet[5] & 0x80)
+            elif (counter != last and (not pF or counter != (last + 1) & 0x0F)
+                  and not (flags & 0x20 and packet[4] and packet[5] & 0x80)):
+                add(ccErrors, pid)
+            lastCounter[pid] = counter
+        # Adaptation
+        offset = 4
+        if flags & 0x20:
+            length = packet[4]
+            if length >= 7 and packet[5] & 0x10:
+                pcr = tstools.parse_pcr(packet[6:12])
+                if pid in pcrLast:
+                    pcr_interval(chunk, pid, pcr)
+                else:
+                    chunk.pcrFirst[pid] = pcr
+                pcrLast[pid] = pcr
+                add(chunk.pcrCount, pid)
+            offset += 1 + length
+        if not pF or offset >= 188:
+            continue
+        # Sections
+        data = packet[offset:]
+        pusi = packet[1] & 0x40
+        isPes = False
+        if pusi:
+            if data[0] | data[1] == 0 and data[2] == 1:  # PES
+                isPes = True
+            elif (data[0] == 0x47 and data[1] | 0x80 == 0xE0 and
+                  data[2] == 0x0F):  # DVB-MIP
+                continue
+        if pid not in opened:  # May end a section of a previous chunk
+            payloads = head.setdefault(pid, [])
+            if not pusi:
+                if headSize.get(pid, 0) < tstools.SECTION_MAX:
+                    payloads.append((i, bytes(data)))
+                    add(headSize, pid, len(data))
+                continue
+            opened.add(pid)
+            payloads.append((i, b"" if isPes else bytes(data[1:data[0] + 1])))
+            payloads.append(None)  # Closed by the PUSI
+        if isPes:
+            sections.drop(pid)
+            continue
+        for section in feed(pid, pusi, data):
+            sections_append((i, pid, section))
+    for pid, (buffer, filled, length) in sections.buffers.items():
+        if filled:
+            chunk.tail[pid] = (bytes(buffer[:filled]), length)
+    chunk.lost = sync.lost
+    return chunk
+
+
+def bounded(view, start, stop):
+    """Yield the bytes [start, stop) of view and LOOKAHEAD bytes more, so
+    a sync loss near stop is resolved like in the middle of the file"""
+    yield view[start:stop]
+    if stop < len(view):
+        yield view[stop:stop + LOOKAHEAD]
+
+
+def stitch(tail, payloads, pid, out):
+    """Continue the partial section tail with the head payloads of pid
+    Append the completed sections to out and return the new tail"""
+    if tail is None:
+        return None
+    state = [bytearray(tstools.SECTION_MAX), len(tail[0]), tail[1]]
+    state[0][:len(tail[0])] = tail[0]
+    sections = tstools.Sections()
+    sections.buffers[pid] = state
+    for payload in payloads:
+        if payload is None:  # A PUSI drops what is left
+            return None
+        i, data = payload
+        done = sections.feed(pid, 0, data)
+        out.extend((i, pid, section) for section in done)
+        if done:  # Nothing else starts without a PUSI
+            return None
+    return (bytes(state[0][:state[1]]), state[2])
+
+
+def merge(chunks):
+    """Merge the chunks (in stream order) into one Chunk"""
+    total = Chunk()
+    for chunk in chunks:
+        if not total.stop:
+            total.start = chunk.start
+        total.stop = chunk.stop
+        for pid, (counter, pF, indicator) in chunk.first.items():
+            last = total.lastCounter.get(pid)
+            if last is None:
+                total.first[pid] = (counter, pF, indicator)
+            elif (counter != last and (not pF or counter != (last + 1) & 0x0F)
+                  and not indicator):
+                add(total.ccErrors, pid)
+        total.lastCounter.update(chunk.lastCounter)
+        for pid, n in chunk.ccErrors.items():
+            add(total.ccErrors, pid, n)
+        for pid, n in chunk.packets.items():
+            add(total.packets, pid, n)
+        # PCR
+        for pid, pcr in chunk.pcrFirst.items():
+            if pid in total.pcrLast:
+                pcr_interval(total, pid, pcr)
+            else:
+                total.pcrFirst[pid] = pcr
+        total.pcrLast.update(chunk.pcrLast)
+        for pid, n in chunk.pcrCount.items():
+            add(total.pcrCount, pid, n)
+        for pid, n in chunk.pcrErrors.items():
+            add(total.pcrErrors, pid, n)
+        for pid, n in chunk.pcrMax.items():
+            if n > total.pcrMax.get(pid, 0):
+                total.pcrMax[pid] = n
+        # Sections cut by the start of the chunk
+        stitched = []
+        for pid, payloads in chunk.head.items():
+            tail = stitch(total.tail.pop(pid, None), payloads, pid, stitched)
+            if tail is not None:
+                total.tail[pid] = tail
+        for pid, tail in chunk.tail.items():
+            total.tail[pid] = tail
+        total.sections.extend(sorted(stitched + chunk.sections,
+                                     key=lambda s: s[0]))
+        total.lost += chunk.lost
+    return total
+
+
+def cut_point(data, start, end):
+    """Return the first position from start (up to end) with SYNC_CHECKS
+    packets in sync before it and after it, None if there is none"""
+    back = 188 * tstools.SYNC_CHECKS
+    while True:
+        pos, found = tstools.find_sync(data[:end], start, (188,))
+        if not found:
+            return None
+        if pos >= back and bytes(data[pos - back:pos:188]) == tstools.SYNCS:
+            return pos
+        start = pos + 1
+
+
+def split(path, n):
+    """Return up to n (start, stop) byte ranges covering the file at path
+    Every cut is moved to the next cut_point() (dropped if there is none
+    within SPLIT_WINDOW)"""
+    data = memoryview(iotools.MappedFile(path).data)
+    size = len(data)
+    step = -(-size // n) or 1
+    starts = [0]
+    for cut in range(step, size, step):
+        start = cut_point(data, cut, cut + SPLIT_WINDOW)
+        if start is not None and starts[-1] < start < size:
+            starts.append(start)
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def analyze(path, workers=None, chunks=None):
+    """Analyze the ts file at path in a pool of workers processes"""
+    workers = workers or cpu_count()
+    ranges = split(path, chunks or workers * 4)
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(analyze_chunk, path, start, stop)
+                   for start, stop in ranges]
+        return merge(f.result() for f in futures)
+
+
+def analyze_sequential(path):
+    """Same analysis as analyze() in one pass and one process"""
+    return merge([analyze_chunk(path, 0,
+                                len(iotools.MappedFile(path).data))])
+
+
+def summary(chunk):
+    """Return the tables and per PID counters found in a merged chunk"""
+    tables = {}
+    for _, pid, section in chunk.sections:
+        if tstools.check_crc(section):
+            tables[pid, section[0]] = section
+    pat = {}
+    pmt = {}
+    for (pid, tableId), section in tables.items():
+        if pid == 0 and tableId == 0:
+            pat.update(tstools.parse_PAT(section))
+    for (pid, tableId), section in tables.items():
+        if tableId == 2 and pid in pat:
+            pmt[pat[pid]] = tstools.parse_PMT(section)
+    return {"packets": chunk.packets, "ccErrors": chunk.ccErrors,
+            "pcrCount": chunk.pcrCount, "pcrMaxInterval": chunk.pcrMax,
+            "pcrErrors": chunk.pcrErrors, "sections": len(chunk.sections),
+            "pat": pat, "pmt": pmt, "lostBytes": chunk.lost}
+
+
+def main(path, workers=None):
+    pprint(summary(analyze(path, workers)))
+
+
+if __name__ == "__main__":
+    path = ("/home/huxley/Desktop/20180727-145000"
+            "-20180727-145500-RGE1_CAT2_REC.ts")
+    main(path)
@@ -1,19 +1,30 @@
 #! python3
 from os.path import getsize
 from itertools import count
+from time import monotonic, perf_counter
 import iotools
 import tstools
+import vectools
 
 PFMT = "\033[46m[%04d]\033[0m<\033[92m%.3f%%\033[0m>"
+GFMT = "<\033[92m%.3f%%\033[0m>"
 RFMT = "\033[1m\033[91m%s\033[0m"
+PCR_HZ = 27000000
+MAX_PCR_JUMP = PCR_HZ  # 1 second
+MAX_PENDING = 50000  # Packets sent without waiting for a PCR
+PROGRESS = 1  # Seconds between progress lines when saving runs
 
 
 def parse(**kw):
-    """Enter a loop that parses the stream and prints the info"""
-    if "path" in kw:
+    """Enter a loop that parses the stream and prints the info
+    Files are saved run by run (see save_runs) unless coalesce=False or
+    they are followed as they grow (follow=True)"""
+    if "path" in kw and kw.pop("coalesce", True) and not kw.get("follow"):
+        kw.pop("every", None)
+        return save_runs(kw.pop("out", "save.ts"), **kw)
+    fSize = float("inf")
+    if "path" in kw and not kw.get("follow"):
         fSize = getsize(kw["path"]) // 188
-    elif "ip" in kw and "port" in kw:
-        fSize = float("inf")
     # Start loop
     out = kw.pop("out", "save.ts")
     every = kw.pop("every", 1)
@@ -22,7 +33,7 @@ def parse(**kw):
     else:
         every *= fSize // 99.9 * 100
     writer = iotools.Writer(iotools.write_file_queue(out))
-    write = writer.queue.append
+    write = writer.put
     for i, packet in zip(count(0, 100), tstools.loop(**kw)):
         if not i % every:
             pid = ((packet[1] & 0x1F) << 8) + packet[2]
@@ -30,6 +41,128 @@ def parse(**kw):
         write(packet)
     print("Finished reading")
     writer.stop()
+    print("Wrote %(written)d packets in %(batches)d batches (%(MBps).1f MB/s),"
+          " waited %(waits)d times for the writer" % writer.stats())
+
+
+def kept_pids(kw):
+    """Return the set of PIDs loop() would yield for kw"""
+    if "targetPids" in kw:
+        return set(kw.pop("targetPids"))
+    return set(range(1 << 13)) - set(kw.pop("skipPids", tuple()))
+
+
+def find_runs(block, keep, size=188):
+    """Return the (start, stop) byte ranges of the runs of packets of a
+    block of whole packets whose PID is set in keep (8192 bytes)"""
+    out = []
+    start = -1
+    p = tstools.PREFIXES[size]
+    for j in range(0, len(block), size):
+        if keep[((block[j + p + 1] & 0x1F) << 8) + block[j + p + 2]]:
+            if start < 0:
+                start = j
+        elif start >= 0:
+            out.append((start, j))
+            start = -1
+    if start >= 0:
+        out.append((start, len(block)))
+    return out
+
+
+def save_runs(out, **kw):
+    """Save the kept PIDs of the file at path into out
+    Each block of the memory mapped input goes to the writer as the views
+    of its runs of kept packets, no packet is copied or handled alone.
+    Packets keep their size (192 bytes M2TS records with their prefix).
+    From the first block out of sync on, packets go one by one through
+    tstools.walk(), as 188 bytes. Progress is shown every PROGRESS
+    seconds"""
+    pids = kept_pids(kw)
+    if vectools.np is not None:
+        table = vectools.pid_table(pids)
+        block_runs = vectools.runs
+    else:
+        table = bytearray(1 << 13)
+        for pid in pids:
+            table[pid] = 1
+        block_runs = find_runs
+    mapped = iotools.MappedFile(kw["path"])
+    view = memoryview(mapped.data)  # Its view is cut to 188 bytes packets
+    first, size = tstools.find_sync(view[:tstools.BLOCK * 204], 0)
+    if not size:  # Too short to tell
+        first, size = 0, 188
+    prefix = tstools.PREFIXES[size]
+    first = (first - prefix) % size  # Start of the first whole record
+    end = len(view) - (len(view) - first) % size
+    step = kw.get("block", tstools.BLOCK) * size
+    syncs = b"\x47" * (step // size)
+    writer = iotools.Writer(iotools.write_file_queue(out))
+    put_many = writer.put_many
+    nextProgress = monotonic() + PROGRESS
+    for i in range(first + kw.get("start", 0) * size, end, step):
+        block = view[i:min(i + step, end)]
+        if block[prefix::size] != syncs[:len(block) // size]:  # Lost sync
+            if size != 188:
+                print(RFMT % ("Lost sync at byte %d, the rest is saved as "
+                              "188 bytes packets" % i))
+            skipPids = set(range(1 << 13)) - pids
+            put_many(tstools.walk((view[i:],), skipPids, tstools.Sync(size)))
+            break
+        put_many([block[a:b] for a, b in block_runs(block, table, size)])
+        if monotonic() >= nextProgress:
+            print(GFMT % (i * 100 / end))
+            nextProgress = monotonic() + PROGRESS
+    print("Finished reading")
+    writer.stop()
+    print("Wrote %(bytes)d bytes in %(written)d runs and %(batches)d batches"
+          " (%(MBps).1f MB/s), waited %(waits)d times for the writer"
+          % writer.stats())
+
+
+def replay(**kw):
+    """Send a stream to udp://ip:port (to=(ip, port)) in real time
+    Packets go 7 per datagram, at the times given by the PCRs of pcrPid
+    (the first PID carrying PCR by default), evenly spread between them
+    A PCR going back or jumping more than MAX_PCR_JUMP restarts the clock"""
+    sender = iotools.PacedUdp(*kw.pop("to"))
+    send = sender.send
+    pcrPid = kw.pop("pcrPid", None)
+    out = []  # (packet, time) waiting for a full datagram
+    pending = []  # Packets since the last PCR
+    lastPcr = None
+    for packet in tstools.loop(**kw):
+        pending.append(packet)
+        pid = ((packet[1] & 0x1F) << 8) + packet[2]
+        pcr = None
+        if pcrPid is None or pid == pcrPid:
+            pcr = tstools.packet_pcr(packet)
+        if pcr is not None:
+            pcrPid = pid
+        elif len(pending) < MAX_PENDING:
+            continue
+        now = perf_counter()
+        if (pcr is None or lastPcr is None or
+                not 0 < pcr - lastPcr <= MAX_PCR_JUMP):  # Restart the clock
+            out.extend((p, now) for p in pending)
+            start = now
+            base = pcr
+        else:  # Spread the packets between the two PCRs
+            t0 = start + (lastPcr - base) / PCR_HZ
+            step = (pcr - lastPcr) / PCR_HZ / len(pending)
+            out.extend((p, t0 + step * (n + 1)) for n, p in enumerate(pending))
+        lastPcr = pcr
+        pending = []
+        for n in range(0, len(out) - 6, 7):
+            send([p for p, _ in out[n:n + 7]], out[n + 6][1])
+        del out[:len(out) - len(out) % 7]
+    out.extend((p, perf_counter()) for p in pending)
+    for n in range(0, len(out), 7):
+        send([p for p, _ in out[n:n + 7]], out[n][1])
+    sender.close()
+    print("Sent %(datagrams)d datagrams, %(late)d late (up to %(maxLate).4fs)"
+          % sender.stats())
+
 
 if __name__ == "__main__":
     path = ("/home/huxley/Desktop/20180727-145000"
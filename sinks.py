@@ -0,0 +1,55 @@
+#! python3
+from json import dumps
+
+"""
+Events are (kind, args) tuples, formats maps every kind to a pair
+(format, fields): the % format used to show it and the names of args.
+Sinks get the events of a packet together and must not keep the list.
+"""
+
+
+def render(formats, events):
+    """Format events as text lines"""
+    return "\n".join(formats[kind][0] % args for kind, args in events)
+
+
+class ConsoleSink():
+    """Print the events formatted as text (to stdout if file is None)"""
+    def __init__(self, formats, file=None):
+        self.formats = formats
+        self.file = file
+
+    def emit(self, events):
+        print(render(self.formats, events), file=self.file)
+
+    def close(self):
+        pass
+
+
+class JsonSink():
+    """Write every event as a JSON line {"event": kind, field: value...}"""
+    def __init__(self, formats, path):
+        self.formats = formats
+        self.file = open(path, "w")
+
+    def emit(self, events):
+        formats = self.formats
+        lines = []
+        for kind, args in events:
+            record = dict(zip(formats[kind][1], args))
+            record["event"] = kind
+            lines.append(dumps(record, default=str))
+        lines.append("")
+        self.file.write("\n".join(lines))
+
+    def close(self):
+        self.file.close()
+
+
+class NullSink():
+    """Drop every event, for when only the tables and stats matter"""
+    def emit(self, events):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,184 @@
+#! python3
+from collections import deque
+
+"""
+Per PID counters updated in O(1) for every packet, in the spirit of the
+ETR 290 priority 1 and 2 checks
+Time is the stream time: it moves with the PCRs of the first PID that
+carries them, so files and live streams are measured the same way
+Counters are plain lists indexed by PID, snapshot() copies them (each
+copy is atomic under the GIL) so it can run while packets come in
+The walk that owns them (analyzer.Stream.feed) updates them itself, with
+its own continuity check, and calls count_pcr / count_psi. PIDs it skips
+are only counted (packets, bitrate and PSI repetition)
+"""
+
+PIDS = 1 << 13
+PCR_HZ = 27000000
+PCR_REPETITION = 0.04  # Seconds between PCRs of a PID (ETR 290 2.3a)
+PCR_DISCONTINUITY = 0.1  # Seconds, a longer or negative jump (2.3b)
+PCR_ACCURACY = 500e-9  # Seconds of jitter against a constant rate (2.4)
+BUCKET = 0.1  # Seconds of stream time between bitrate samples
+WINDOWS = (1, 10)  # Seconds of the sliding bitrate windows
+# Longest interval (seconds) between sections of fixed PSI PIDs
+PSI_LIMITS = {0: 0.5, 16: 10, 17: 2, 18: 2, 20: 30}
+PMT_LIMIT = 0.5
+
+
+class Stats():
+    def __init__(self, sync=None, start=0):
+        self.sync = sync  # tstools.Sync of the walk, for sync losses
+        self.start = start  # Position (packet index) of the first packet
+        self.time = 0.0
+        self.packets = [0] * PIDS
+        self.seen = []  # PIDs with packets as of the last bitrate sample
+        self.ccErrors = [0] * PIDS
+        self.tei = [0] * PIDS
+        self.crcErrors = [0] * PIDS
+        # PCR
+        self.pcrPid = -1  # Gives the stream time
+        self.pcrLast = [-1] * PIDS
+        self.pcrPosition = [0] * PIDS  # Packets before the last PCR
+        self.pcrRate = [0.0] * PIDS  # Packets per PCR tick
+        self.pcrCount = [0] * PIDS
+        self.pcrMaxInterval = [0] * PIDS
+        self.pcrRepetition = [0] * PIDS
+        self.pcrDiscontinuity = [0] * PIDS
+        self.pcrMaxJitter = [0.0] * PIDS
+        self.pcrInaccurate = [0] * PIDS
+        # PSI repetition
+        self.psiLimit = [0.0] * PIDS
+        self.psiLast = [-1.0] * PIDS
+        self.psiMaxInterval = [0.0] * PIDS
+        self.psiErrors = [0] * PIDS
+        for pid, limit in PSI_LIMITS.items():
+            self.psiLimit[pid] = limit
+        # Bitrate samples (time, {pid: packets}) every BUCKET seconds
+        self.samples = deque(maxlen=int(max(WINDOWS) / BUCKET) + 1)
+        self.nextSample = 0.0
+
+    def watch(self, pid, limit=PMT_LIMIT):
+        """Check that sections start on pid at least every limit seconds"""
+        self.psiLimit[pid] = limit
+
+    def count_pcr(self, pid, pcr, discontinuity, position):
+        """Account the PCR of pid found in the packet at position"""
+        self.pcrCount[pid] += 1
+        last = self.pcrLast[pid]
+        self.pcrLast[pid] = pcr
+        packets = position - self.pcrPosition[pid]
+        self.pcrPosition[pid] = position
+        if self.pcrPid < 0:
+            self.pcrPid = pid
+        if last < 0 or discontinuity:
+            return
+        interval = pcr - last
+        if not 0 < interval <= PCR_DISCONTINUITY * PCR_HZ:
+            self.pcrDiscontinuity[pid] += 1
+            return
+        if interval > self.pcrMaxInterval[pid]:
+            self.pcrMaxInterval[pid] = interval
+        if interval > PCR_REPETITION * PCR_HZ:
+            self.pcrRepetition[pid] += 1
+        # Jitter against the rate seen so far
+        rate = self.pcrRate[pid]
+        if rate:
+            jitter = abs(interval - packets / rate) / PCR_HZ
+            if jitter > self.pcrMaxJitter[pid]:
+                self.pcrMaxJitter[pid] = jitter
+            if jitter > PCR_ACCURACY:
+                self.pcrInaccurate[pid] += 1
+            self.pcrRate[pid] = rate * 0.9 + packets / interval * 0.1
+        else:
+            self.pcrRate[pid] = packets / interval
+        if pid == self.pcrPid:
+            self.time += interval / PCR_HZ
+            if self.time >= self.nextSample:
+                self.sample(position - self.start + 1)
+                self.nextSample = self.time + BUCKET
+
+    def sample(self, total):
+        """Keep the packets of the PIDs seen, total are counted so far
+        (every PID is looked at again only when some are new)"""
+        packets = self.packets
+        counts = [packets[pid] for pid in self.seen]
+        if sum(counts) != total:
+            self.seen = [pid for pid in range(PIDS) if packets[pid]]
+            counts = [packets[pid] for pid in self.seen]
+        self.samples.append((self.time, dict(zip(self.seen, counts))))
+
+    def count_psi(self, pid):
+        time = self.time
+        last = self.psiLast[pid]
+        self.psiLast[pid] = time
+        if last < 0:
+            return
+        interval = time - last
+        if interval > self.psiMaxInterval[pid]:
+            self.psiMaxInterval[pid] = interval
+        if interval > self.psiLimit[pid]:
+            self.psiErrors[pid] += 1
+
+    def bitrates(self, window, packets):
+        """Return the bits/s of every PID over the last window seconds"""
+        samples = list(self.samples)
+        if not samples:
+            return {}
+        for time, counts in samples:
+            if self.time - time <= window:
+                break
+        elapsed = self.time - time
+        if elapsed <= 0:
+            return {}
+        return dict((pid, (packets[pid] - counts.get(pid, 0)) * 188 * 8 /
+                     elapsed) for pid in range(PIDS) if packets[pid])
+
+    def snapshot(self):
+        """Return the counters of every PID seen and the ETR 290 totals"""
+        packets = list(self.packets)
+        ccErrors = list(self.ccErrors)
+        tei = list(self.tei)
+        crcErrors = list(self.crcErrors)
+        pcrCount = list(self.pcrCount)
+        psiLimit = list(self.psiLimit)
+        psiLast = list(self.psiLast)
+        psiErrors = list(self.psiErrors)
+        time = self.time
+        rates = dict((w, self.bitrates(w, packets)) for w in WINDOWS)
+        pids = {}
+        for pid in range(PIDS):
+            if not (packets[pid] or psiLimit[pid] and psiLast[pid] >= 0):
+                continue
+            info = {"packets": packets[pid], "ccErrors": ccErrors[pid],
+                    "tei": tei[pid], "crcErrors": crcErrors[pid]}
+            for w in WINDOWS:
+                info["bitrate%ds" % w] = rates[w].get(pid, 0.0)
+            if pcrCount[pid]:
+                info["pcr"] = {
+                    "count": pcrCount[pid],
+                    "maxInterval": self.pcrMaxInterval[pid] / PCR_HZ,
+                    "repetitionErrors": self.pcrRepetition[pid],
+                    "discontinuities": self.pcrDiscontinuity[pid],
+                    "maxJitter": self.pcrMaxJitter[pid],
+                    "accuracyErrors": self.pcrInaccurate[pid]}
+            if psiLimit[pid]:
+                late = psiLast[pid] < 0 or time - psiLast[pid] > psiLimit[pid]
+                info["psi"] = {"limit": psiLimit[pid], "late": late,
+                               "maxInterval": self.psiMaxInterval[pid],
+                               "errors": psiErrors[pid]}
+            pids[pid] = info
+        pmtPids = [p for p in range(PIDS)
+                   if psiLimit[p] == PMT_LIMIT and p not in PSI_LIMITS]
+        return {
+            "time": time, "packets": sum(packets), "pids": pids,
+            "priority1": {
+                "syncLosses": self.sync.losses if self.sync else 0,
+                "patErrors": psiErrors[0],
+                "ccErrors": sum(ccErrors),
+                "pmtErrors": sum(psiErrors[p] for p in pmtPids)},
+            "priority2": {
+                "transportErrors": sum(tei),
+                "crcErrors": sum(crcErrors),
+                "pcrRepetitionErrors": sum(self.pcrRepetition),
+                "pcrDiscontinuities": sum(self.pcrDiscontinuity),
+                "pcrAccuracyErrors": sum(self.pcrInaccurate)}}
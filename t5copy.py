@@ -1,68 +1,192 @@
 #! python3
 import iotools
 import tstools
-from subprocess import Popen
-from multiprocessing import Process
 
 """
-Process 0:
-    1. Filter PAT (0x00) -> Launch 2
-    2. Filter specific PMT (defined in PAT) -> Launch 3, Subprocess(1.1)
-    3. Filter any PSI and edit if PAT, PMT, SDT, EIT --> Send to localhost:9876
-    3*  Change Sync byte from 0x47 to 0x48
-Process 1:
-    1. FFMPEG --> Send to localhost:9876
-Process 2:
-    1. Listen to localhost:9876
-    1*  Filter PES if sync byte == 0x47
-    1*  Pass any if sync byte == 0x48
-
-* By now ignore stuffing
+Copy a single program (SPTS) out of a stream in one pass:
+    1. PAT (0x00) is followed to find the PMT of the program and is
+       rewritten to list that program alone (new CRC)
+    2. PMT is passed through and followed to find the PCR and ES PIDs
+    3. Packets of the PMT, PCR and ES PIDs are passed through as they are
+    4. Optionally the SDT is cut to the service of the program (new CRC)
+       and only the EIT sections of that service are kept
+Everything goes out to a file or to udp://localhost:9876, listen()
+saves what arrives there
 """
 
 RFMT = "\033[1m\033[91m%s\033[0m"
+HOST = "127.0.0.1"
+PORT = 9876
+DATAGRAM = 7  # Packets per datagram
+EIT_ACTUAL = set([0x4E])
+EIT_ACTUAL.update(range(0x50, 0x5F + 1))
+
+
+def with_crc(section):
+    """Return section (without crc) with its length fixed and a new crc"""
+    section = bytearray(section)
+    length = len(section) + 4 - 3
+    section[1] = (section[1] & 0xF0) | (length >> 8)
+    section[2] = length & 0xFF
+    return bytes(section) + tstools.crc32(section).to_bytes(4, "big")
+
+
+def packetize(pid, sections, counter):
+    """Return the packets carrying sections on pid, continuity counters
+    go on from counter (the last one used)"""
+    data = b"\x00" + b"".join(sections)  # Pointer field
+    packets = []
+    for i in range(0, len(data), 184):
+        counter = (counter + 1) & 0x0F
+        payload = data[i:i + 184]
+        header = bytes((0x47, (0x40 if not i else 0) | (pid >> 8),
+                        pid & 0xFF, 0x10 | counter))
+        packets.append(header + payload + b"\xFF" * (184 - len(payload)))
+    return packets
+
+
+class Extractor():
+    """Keep the packets of one program, see the module doc"""
+    def __init__(self, program, sdt=False, eit=False):
+        self.program = program
+        self.pmtPid = None
+        self.pids = set()  # PCR and ES PIDs
+        self.sections = tstools.Sections()
+        self.psiPids = set([0])
+        if sdt:
+            self.psiPids.add(17)
+        if eit:
+            self.psiPids.add(18)
+        self.counters = {}  # pid -> last counter of the rewritten PIDs
+        self.dropped = 0
+
+    def feed(self, packet):
+        """Return the packets to send for packet"""
+        pid = ((packet[1] & 0x1F) << 8) + packet[2]
+        if pid in self.pids:
+            return (packet,)
+        if pid == self.pmtPid:
+            self.follow(pid, packet, self.parse_PMT)
+            return (packet,)
+        if pid in self.psiPids:
+            return self.follow(pid, packet, self.rewrite)
+        self.dropped += 1
+        return ()
+
+    def follow(self, pid, packet, parse):
+        """Feed the payload of packet to the sections of pid and return
+        the packets made by parse for the completed ones"""
+        flags = packet[3]
+        if not flags & 0x10:
+            return ()
+        offset = 4
+        if flags & 0x20:
+            offset += 1 + packet[4]
+        if offset >= 188:
+            return ()
+        out = []
+        done = self.sections.feed(pid, packet[1] & 0x40, packet[offset:])
+        for section in done:
+            if tstools.check_crc(section):
+                out.extend(parse(pid, section))
+        return out
+
+    def parse_PMT(self, pid, section):
+        # Programs may share a PMT PID, keep the PMT of self.program only
+        if section[0] != 2 or (section[3] << 8) + section[4] != self.program:
+            return ()
+        pcrPid = ((section[8] & 0x1F) << 8) + section[9]
+        self.pids = set(tstools.parse_PMT(section))
+        self.pids.add(pcrPid)
+        return ()
+
+    def rewrite(self, pid, section):
+        """Return the packets of section cut to the program, if any"""
+        tableId = section[0]
+        body = section[8:-4]
+        if pid == 0 and tableId == 0:
+            for i in range(0, len(body), 4):
+                if (body[i] << 8) + body[i + 1] == self.program:
+                    pmtPid = ((body[i + 2] & 0x1F) << 8) + body[i + 3]
+                    if pmtPid != self.pmtPid:
+                        self.pmtPid = pmtPid
+                        self.sections.drop(pmtPid)
+                    # Section 0 of 0 with the program alone
+                    section = with_crc(section[:6] + b"\x00\x00" +
+                                       body[i:i + 4])
+                    break
+            else:
+                return ()
+        elif pid == 17 and tableId == 0x42:  # SDT actual
+            services = []
+            data = body[3:]  # After original_network_id
+            while len(data) >= 5:
+                length = ((data[3] & 0x0F) << 8) + data[4] + 5
+                if (data[0] << 8) + data[1] == self.program:
+                    services.append(data[:length])
+                data = data[length:]
+            if not services:
+                return ()
+            # Section 0 of 0 with the service alone, like the PAT
+            section = with_crc(section[:6] + b"\x00\x00" + section[8:11] +
+                               b"".join(services))
+        elif pid == 18 and tableId in EIT_ACTUAL:
+            if (section[3] << 8) + section[4] != self.program:
+                return ()
+        else:
+            return ()
+        packets = packetize(pid, (section,), self.counters.get(pid, 15))
+        self.counters[pid] = packets[-1][3] & 0x0F
+        return packets
+
+
+def extract(program, out=None, sdt=False, eit=False, **kw):
+    """Copy the program of the stream in kw (like tstools.loop) to the
+    file out, or to udp://HOST:PORT if out is None"""
+    extractor = Extractor(program, sdt, eit)
+    feed = extractor.feed
+    if out is None:
+        writer = iotools.Writer(iotools.write_udp(HOST, PORT))
+        pending = []
+        for packet in tstools.loop(**kw):
+            pending.extend(feed(packet))
+            if len(pending) >= DATAGRAM:
+                writer.put(b"".join(pending[:DATAGRAM]))
+                del pending[:DATAGRAM]
+        if pending:
+            writer.put(b"".join(pending))
+    else:
+        writer = iotools.Writer(iotools.write_file_queue(out))
+        put_many = writer.put_many
+        for packet in tstools.loop(**kw):
+            packets = feed(packet)
+            if packets:
+                put_many(packets)
+    writer.stop()
+    if extractor.pmtPid is None:
+        print(RFMT % ("Program %d not found in the PAT" % program))
+    return extractor
+
+
+def listen(out="save.ts", **kw):
+    """Save what arrives to udp://HOST:PORT into the file out"""
+    writer = iotools.Writer(iotools.write_file_queue(out))
+    try:
+        for block in tstools.open_blocks(dict(kw, ip=HOST, port=PORT)):
+            writer.put(block)
+    except KeyboardInterrupt:
+        print(RFMT % "Keyboard Interrupt")
+    finally:
+        writer.stop()
 
 
 def main(**kw):
-    p = Process(target=listen, kwargs=kw)
-    p.start()
-    filter(**kw)
-
-
-def filter(**kw):
-    """Process 0"""
-    program = kw.pop("program")
-    # 1
-    for payload in tstools.store_PSI(targetPids=(0,), **kw):
-        pat = tstools.parse_PAT(payload)
-        break
-    reversedPat = dict((j, i) for i, j in pat.items())
-    pmtPid = reversedPat[program]
-    # 2
-    for payload in tstools.store_PSI(targetPids=(pmtPid,), **kw):
-        pmt = tstools.parse_PMT(payload)
-        break
-    p = ffmpeg(pmt, kw["path"])
-    # 3
-    for pid, pusi, pF, aF, packet in tstools.parsed_loop(targetPids=pmt, **kw):
-        pass
-
-
-def ffmpeg(pmt, inp):
-    """Process 1"""
-    maps = " ".join("-map i:%s" % hex(i) for i in pmt)
-    streams = " ".join("-streamid %d:%d" % (a, i) for a, i in enumerate(pmt))
-    line = ("ffmpeg -y -i %s %s %s -copy_unknown -c copy"
-            " save.ts") % (inp, maps, streams)  # TODO udp://localhost:9876
-    return Popen(line, shell=True)
-
-
-def listen(**kw):
-    """Process 2"""
-    pass
+    extractor = extract(**kw)
+    print("Kept PMT %s and PIDs %s, dropped %d packets" %
+          (extractor.pmtPid, sorted(extractor.pids), extractor.dropped))
 
 
 if __name__ == "__main__":
     path = ("/home/huxley/Desktop/20180727-145000"
             "-20180727-145500-RGE1_CAT2_REC.ts")
-    main(path=path, program=498)
+    main(path=path, program=498, out="save.ts")
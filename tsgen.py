@@ -0,0 +1,267 @@
+#! python3
+from random import Random
+import tstools
+
+"""
+Deterministic synthetic multiplex: the same arguments always give the
+same bytes, so benchmarks and checks do not depend on a capture
+Every program has a PMT, a video PID carrying the PCR and audio PIDs,
+all with PES timed from the packet position at a constant bitrate.
+PAT, PMT, SDT and EIT present/following repeat every psiInterval, TDT
+every second and the rest of the bitrate is stuffing (PID 8191).
+With pcrOnly the PCRs go in packets of their own, adaptation only
+(without payload, so their continuity counter does not move)
+errors maps kinds of error to their probability per packet:
+    cc: skip a continuity counter, tei: set the transport error bit,
+    crc: corrupt a byte of a PSI packet, sync: insert garbage bytes,
+    dup: send the packet twice
+"""
+
+PCR_HZ = 27000000
+PTS_HZ = 90000
+DELAY = 0.5  # Seconds between the PCR and the PTS of the same instant
+MJD_EPOCH = 58326  # 2018-07-27, the date of the TDT
+STREAM_VIDEO = 0x1B
+STREAM_AUDIO = 0x03
+
+
+def section(tableId, ext, body, version=0, private=False):
+    """Return a long form section with its crc"""
+    length = 5 + len(body) + 4
+    head = bytes((tableId, (0xB0 if not private else 0xF0) | (length >> 8),
+                  length & 0xFF, ext >> 8, ext & 0xFF,
+                  0xC1 | (version & 0x1F) << 1, 0, 0))
+    return head + body + tstools.crc32(head + body).to_bytes(4, "big")
+
+
+def timestamp(prefix, t):
+    """5 bytes PTS / DTS field of t (90kHz)"""
+    return bytes((prefix << 4 | (t >> 29) & 0x0E | 1, (t >> 22) & 0xFF,
+                  (t >> 14) & 0xFE | 1, (t >> 7) & 0xFF, (t << 1) & 0xFE | 1))
+
+
+def pcr_field(pcr):
+    base, extension = divmod(pcr, 300)
+    return bytes(((base >> 25) & 0xFF, (base >> 17) & 0xFF,
+                  (base >> 9) & 0xFF, (base >> 1) & 0xFF,
+                  (base & 1) << 7 | 0x7E | extension >> 8,
+                  extension & 0xFF))
+
+
+def escr_field(escr):
+    """6 bytes ESCR field of escr (27MHz) with its marker bits"""
+    base, extension = divmod(escr, 300)
+    field = (0xC0 << 40 | (base >> 30 & 0x07) << 43 | 1 << 42 |
+             (base >> 15 & 0x7FFF) << 27 | 1 << 26 | (base & 0x7FFF) << 11 |
+             1 << 10 | extension << 1 | 1)
+    return field.to_bytes(6, "big")
+
+
+def bcd(n):
+    return (n // 10) << 4 | n % 10
+
+
+class Elementary():
+    """An ES PID and the PES it is cutting into packets"""
+    def __init__(self, pid, streamType, weight, pesSize):
+        self.pid = pid
+        self.streamType = streamType
+        self.weight = weight  # Share of the packets
+        self.pesSize = pesSize
+        self.pending = b""
+
+
+class Multiplex():
+    def __init__(self, programs=4, audios=2, bitrate=20e6, seed=0,
+                 psiInterval=0.1, pcrInterval=0.03, pesSize=4000,
+                 stuffing=0.1, errors=None, pcrOnly=False):
+        self.rand = Random(seed)
+        self.pcrOnly = pcrOnly
+        self.bitrate = bitrate
+        self.psiInterval = psiInterval
+        self.pcrInterval = pcrInterval
+        self.stuffing = stuffing
+        self.errors = errors or {}
+        self.counters = {}
+        self.programs = []  # (number, pmtPid, [Elementary])
+        self.streams = []
+        for n in range(1, programs + 1):
+            base = 0x100 * n
+            video = Elementary(base + 1, STREAM_VIDEO, 8, pesSize)
+            es = [video] + [Elementary(base + 2 + a, STREAM_AUDIO, 1,
+                                       pesSize // 8) for a in range(audios)]
+            self.programs.append((n, base, es))
+            self.streams.extend(es)
+        self.weights = [e.weight for e in self.streams]
+
+    def psi(self, now):
+        """Return the PSI packets repeated at now (seconds)"""
+        programs = self.programs
+        pat = section(0, 1, b"".join(bytes((n >> 8, n & 0xFF,
+                                            0xE0 | pmt >> 8, pmt & 0xFF))
+                                     for n, pmt, _ in programs))
+        out = self.packetize(0, pat)
+        for n, pmt, es in programs:
+            body = bytes((0xE0 | es[0].pid >> 8, es[0].pid & 0xFF, 0xF0, 0))
+            for e in es:
+                body += bytes((e.streamType, 0xE0 | e.pid >> 8, e.pid & 0xFF,
+                               0xF0, 0))
+            out += self.packetize(pmt, section(2, n, body))
+        services = b""
+        for n, _, _ in programs:
+            name = b"Service %d" % n
+            descriptor = (bytes((72, 3 + 8 + len(name), 1, 8)) + b"Provider" +
+                          bytes((len(name),)) + name)
+            services += bytes((n >> 8, n & 0xFF, 0xFC, 0x80,
+                               len(descriptor))) + descriptor
+        out += self.packetize(17, section(0x42, 1, b"\x00\x01\xFF" +
+                                          services))
+        for n, _, _ in programs:
+            name = b"Event %d" % n
+            text = b"Synthetic event"
+            info = (bytes((77, 5 + len(name) + len(text))) + b"eng" +
+                    bytes((len(name),)) + name + bytes((len(text),)) + text)
+            event = (bytes((0, n, MJD_EPOCH >> 8, MJD_EPOCH & 0xFF,
+                            0x14, 0x50, 0, 0, 0x30, 0, 0x80 | len(info) >> 8,
+                            len(info) & 0xFF)) + info)
+            out += self.packetize(18, section(0x4E, n, b"\x00\x01\x00\x01"
+                                              b"\x00\x4E" + event))
+        if int(now) != int(now - self.psiInterval):  # Every second
+            seconds = int(now)
+            tdt = bytes((0x70, 0x70, 5, MJD_EPOCH >> 8, MJD_EPOCH & 0xFF,
+                         bcd(14), bcd(50 + seconds // 60 % 10),
+                         bcd(seconds % 60)))
+            out += self.packetize(20, tdt)
+        return out
+
+    def counter(self, pid):
+        c = self.counters.get(pid, -1) + 1
+        if self.errors.get("cc") and self.rand.random() < self.errors["cc"]:
+            c += 1
+        self.counters[pid] = c & 0x0F
+        return c & 0x0F
+
+    def packetize(self, pid, data):
+        """Return the packets of a section (pointer field added)"""
+        data = b"\x00" + data
+        out = []
+        for i in range(0, len(data), 184):
+            payload = data[i:i + 184]
+            out.append(bytes((0x47, (0 if i else 0x40) | pid >> 8, pid & 0xFF,
+                              0x10 | self.counter(pid))) + payload +
+                       b"\xFF" * (184 - len(payload)))
+        return out
+
+    def es_packet(self, e, now):
+        """Return the next packet of the elementary stream e"""
+        if self.pcrOnly and self.pcr_due(e.pid, now):
+            return (bytes((0x47, e.pid >> 8, e.pid & 0xFF,
+                           0x20 | self.counters.get(e.pid, 0), 183, 0x10)) +
+                    pcr_field(int(now * PCR_HZ)) + b"\xFF" * 176)
+        pusi = 0
+        if not e.pending:
+            pts = int((now + DELAY) * PTS_HZ)
+            if e.streamType == STREAM_VIDEO:
+                header = b"\x80\xC0\x0A" + timestamp(3, pts) + timestamp(
+                    1, pts - PTS_HZ // 25)
+                length = 0  # Unbounded
+            else:
+                header = b"\x80\x80\x05" + timestamp(2, pts)
+                length = len(header) + e.pesSize
+            streamId = 0xE0 if e.streamType == STREAM_VIDEO else 0xC0
+            pattern = bytes(self.rand.getrandbits(8) for _ in range(16))
+            e.pending = (b"\x00\x00\x01" + bytes((streamId, length >> 8,
+                                                  length & 0xFF)) + header +
+                         (pattern * (e.pesSize // 16 + 1))[:e.pesSize])
+            pusi = 0x40
+        hasField = not self.pcrOnly and self.pcr_due(e.pid, now)
+        adaptation = b""  # Adaptation field after its length byte
+        if hasField:
+            adaptation = b"\x10" + pcr_field(int(now * PCR_HZ))
+        room = 184 - (1 + len(adaptation) if hasField else 0)
+        payload = e.pending[:room]
+        e.pending = e.pending[room:]
+        short = room - len(payload)
+        if short:  # End of the PES, stuff the adaptation field
+            if not hasField:
+                hasField = True
+                short -= 1  # Length byte
+                if short:
+                    adaptation = b"\x00"  # Flags
+                    short -= 1
+            adaptation += b"\xFF" * short
+        flags = 0x10
+        field = b""
+        if hasField:
+            flags |= 0x20
+            field = bytes((len(adaptation),)) + adaptation
+        return (bytes((0x47, pusi | e.pid >> 8, e.pid & 0xFF,
+                       flags | self.counter(e.pid))) + field + payload)
+
+    def pcr_due(self, pid, now):
+        last = self.lastPcr.get(pid)
+        if pid not in self.pcrPids or (last is not None and
+                                       now - last < self.pcrInterval):
+            return False
+        self.lastPcr[pid] = now
+        return True
+
+    def packets(self, n):
+        """Yield n packets (and the garbage of sync errors)"""
+        rand = self.rand
+        errors = self.errors
+        streams = self.streams
+        weights = self.weights
+        self.pcrPids = set(es[0].pid for _, _, es in self.programs)
+        self.psiPids = set([0, 17, 18, 20])
+        self.psiPids.update(pmt for _, pmt, _ in self.programs)
+        self.lastPcr = {}
+        step = 188 * 8 / self.bitrate
+        nextPsi = 0.0
+        queue = []
+        for i in range(n):
+            now = i * step
+            if now >= nextPsi:
+                queue.extend(self.psi(now))
+                nextPsi += self.psiInterval
+            if queue:
+                packet = queue.pop(0)
+            elif rand.random() < self.stuffing:
+                packet = b"\x47\x1F\xFF\x10" + b"\xFF" * 184
+            else:
+                e = rand.choices(streams, weights)[0]
+                packet = self.es_packet(e, now)
+            if errors:
+                packet = self.corrupt(packet)
+                if errors.get("dup") and rand.random() < errors["dup"]:
+                    yield packet
+            yield packet
+
+    def corrupt(self, packet):
+        rand = self.rand
+        errors = self.errors
+        pid = ((packet[1] & 0x1F) << 8) + packet[2]
+        if errors.get("tei") and rand.random() < errors["tei"]:
+            packet = packet[:1] + bytes((packet[1] | 0x80,)) + packet[2:]
+        if (pid in self.psiPids and errors.get("crc") and
+                rand.random() < errors["crc"]):
+            i = rand.randrange(5, 188)
+            packet = packet[:i] + bytes((packet[i] ^ 0x01,)) + packet[i + 1:]
+        if errors.get("sync") and rand.random() < errors["sync"]:
+            packet = bytes(rand.randrange(1, 0x47) for _ in range(
+                rand.randrange(1, 188))) + packet
+        return packet
+
+    def write(self, path, n):
+        """Write n packets to the file at path"""
+        with open(path, "wb") as f:
+            f.write(b"".join(self.packets(n)))
+
+
+def generate(path, n=100000, **kw):
+    """Write n packets of a Multiplex(**kw) to the file at path"""
+    Multiplex(**kw).write(path, n)
+
+
+if __name__ == "__main__":
+    generate("synthetic.ts", 100000, errors={"cc": 1e-4, "tei": 1e-5})
@@ -0,0 +1,203 @@
+#! python3
+from bisect import bisect_right
+from os import stat
+from struct import Struct
+import iotools
+import tstools
+
+"""
+Seek index of a recorded capture, kept in a sidecar file next to it
+(path + SUFFIX) so a time range can be cut without reading the whole file
+Every entry is the byte offset of a packet (of its M2TS time stamp for
+192 bytes packets) and a value:
+    PCR: the PCR (27MHz), PTS: the PTS (90kHz) of a PES start,
+    TDT: the unix time of a TDT, RAI: the last PCR before a packet with
+    the random access indicator
+The sidecar has a HEADER and then ENTRY records, both little endian, it
+is rebuilt when the size or the modification time of the capture change
+"""
+
+SUFFIX = ".idx"
+MAGIC = b"TSIX"
+VERSION = 2  # 2: M2TS offsets before the time stamp
+HEADER = Struct("<4sBxHQd")  # Magic, version, packet size, size, mtime
+ENTRY = Struct("<BxHQq")  # Kind, pid, byte offset, value
+PCR, PTS, TDT, RAI = 1, 2, 3, 4
+PCR_HZ = 27000000
+PCR_MAX_JUMP = PCR_HZ  # A longer or negative jump is a discontinuity
+
+
+class Index():
+    """Entries of a capture, by kind: (offsets, values, pids) lists in
+    stream order, offsets only go up"""
+    def __init__(self, size=0, mtime=0.0, packetSize=188):
+        self.size = size
+        self.mtime = mtime
+        self.packetSize = packetSize
+        self.entries = dict((k, ([], [], [])) for k in (PCR, PTS, TDT, RAI))
+        self.times = None  # Seconds since the first PCR, see elapsed()
+        self.pts = None  # pid -> (sorted PTS, offsets), see pts_offset()
+
+    def add(self, kind, pid, offset, value):
+        offsets, values, pids = self.entries[kind]
+        offsets.append(offset)
+        values.append(value)
+        pids.append(pid)
+
+    def elapsed(self):
+        """Seconds of stream time at every PCR entry
+        The PCRs of the first PID carrying them count, discontinuities
+        add no time so the list never goes back"""
+        if self.times is None:
+            offsets, values, pids = self.entries[PCR]
+            times = []
+            time = 0.0
+            last = None
+            for value, pid in zip(values, pids):
+                if pid != pids[0]:
+                    times.append(time)
+                    continue
+                if last is not None and 0 < value - last <= PCR_MAX_JUMP:
+                    time += (value - last) / PCR_HZ
+                last = value
+                times.append(time)
+            self.times = times
+        return self.times
+
+    def time_offset(self, seconds):
+        """Byte offset of the last PCR at or before seconds of stream"""
+        i = bisect_right(self.elapsed(), seconds) - 1
+        return self.entries[PCR][0][i] if i >= 0 else 0
+
+    def tdt_offset(self, unixTime):
+        """Byte offset of the last TDT at or before unixTime"""
+        offsets, values, _ = self.entries[TDT]
+        i = bisect_right(values, unixTime) - 1
+        return offsets[i] if i >= 0 else 0
+
+    def pts_offset(self, pid, pts):
+        """Byte offset of the PES of pid with the last PTS at or before pts
+        (the PTS of every PID are sorted once, with their offsets)"""
+        if self.pts is None:
+            entries = {}
+            offsets, values, pids = self.entries[PTS]
+            for offset, value, p in zip(offsets, values, pids):
+                entries.setdefault(p, []).append((value, offset))
+            self.pts = {}
+            for p, pes in entries.items():
+                pes.sort()
+                self.pts[p] = ([v for v, _ in pes], [o for _, o in pes])
+        values, offsets = self.pts.get(pid, ((), ()))
+        i = bisect_right(values, pts) - 1
+        return offsets[i] if i >= 0 else 0
+
+    def rai_before(self, offset):
+        """Byte offset of the last random access point at or before offset"""
+        offsets = self.entries[RAI][0]
+        i = bisect_right(offsets, offset) - 1
+        return offsets[i] if i >= 0 else offset
+
+
+def build(path):
+    """Read the whole capture at path and return its Index"""
+    info = stat(path)
+    sync = tstools.Sync()
+    blocks = iotools.MappedFile(path).blocks()
+    index = None
+    add = None
+    lastPcr = -1
+    for i, packet in enumerate(tstools.walk(blocks, (), sync)):
+        if index is None:
+            index = Index(info.st_size, info.st_mtime, sync.size)
+            add = index.add
+        # Start of the packet, its M2TS time stamp included
+        offset = i * sync.size + sync.lost - tstools.PREFIXES[sync.size]
+        pid = ((packet[1] & 0x1F) << 8) + packet[2]
+        flags = packet[3]
+        start = 4
+        if flags & 0x20:
+            length = packet[4]
+            if length:
+                if packet[5] & 0x10 and length >= 7:
+                    lastPcr = tstools.parse_pcr(packet[6:12])
+                    add(PCR, pid, offset, lastPcr)
+                if packet[5] & 0x40:
+                    add(RAI, pid, offset, lastPcr)
+            start += 1 + length
+        if not (flags & 0x10 and packet[1] & 0x40) or start > 180:
+            continue
+        data = packet[start:]
+        if data[0] | data[1] == 0 and data[2] == 1:  # PES
+            pts = tstools.parse_PES_header(pid, data).pts
+            if pts is not None:
+                add(PTS, pid, offset, pts)
+        elif pid == 20:
+            section = data[data[0] + 1:]
+            if len(section) >= 8 and section[0] == 0x70:  # TDT
+                add(TDT, pid, offset, tstools.parse_utc(section[3:8]))
+    return index or Index(info.st_size, info.st_mtime)
+
+
+def save(index, path):
+    """Write index to the sidecar of the capture at path"""
+    with open(path + SUFFIX, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, index.packetSize, index.size,
+                            index.mtime))
+        pack = ENTRY.pack
+        for kind, (offsets, values, pids) in index.entries.items():
+            f.write(b"".join(pack(kind, pid, offset, value) for
+                             offset, value, pid in zip(offsets, values, pids)))
+
+
+def load(path):
+    """Return the Index in the sidecar of the capture at path, None if
+    there is none or it is out of date"""
+    try:
+        with open(path + SUFFIX, "rb") as f:
+            data = f.read()
+        info = stat(path)
+    except OSError:
+        return None
+    if len(data) < HEADER.size:
+        return None
+    magic, version, packetSize, size, mtime = HEADER.unpack_from(data)
+    if (magic != MAGIC or version != VERSION or size != info.st_size or
+            mtime != info.st_mtime):
+        return None
+    index = Index(size, mtime, packetSize)
+    add = index.add
+    for kind, pid, offset, value in ENTRY.iter_unpack(data[HEADER.size:]):
+        add(kind, pid, offset, value)
+    return index
+
+
+def open_index(path):
+    """Load the index of the capture at path, building it if needed"""
+    index = load(path)
+    if index is None:
+        index = build(path)
+        save(index, path)
+    return index
+
+
+def clip(path, start, duration, out, rai=True):
+    """Copy duration seconds of the capture at path, from start seconds
+    of stream time (from the random access point before it with rai)"""
+    index = open_index(path)
+    begin = index.time_offset(start)
+    if rai:
+        begin = index.rai_before(begin)
+    end = index.size
+    times = index.elapsed()
+    if times and start + duration < times[-1]:
+        end = index.time_offset(start + duration)
+    with open(path, "rb") as f, open(out, "wb") as o:
+        f.seek(begin)
+        o.write(f.read(end - begin))
+    return begin, end
+
+
+if __name__ == "__main__":
+    path = ("/home/huxley/Desktop/20180727-145000"
+            "-20180727-145500-RGE1_CAT2_REC.ts")
+    print(clip(path, 60, 30, "clip.ts"))
@@ -1,10 +1,21 @@
 #! python3
 import iotools
 from time import gmtime
+from zlib import crc32 as zlib_crc32
 
 RFMT = "\033[1m\033[91m%s\033[0m"
 MJD_TO_UNIX = 40588
 DAY = 86400
+BLOCK = 1024  # Packets read at once
+SIZES = (188, 192, 204)  # Plain, M2TS and FEC packets
+# Bytes of a packet before its sync byte (the M2TS time stamp)
+PREFIXES = {188: 0, 192: 4, 204: 0}
+SYNC_CHECKS = 5  # Sync bytes in a row needed to lock
+SYNCS = b"\x47" * SYNC_CHECKS
+SECTION_MAX = 4096 + 3  # Longest private section with its header
+PES_MAX = 1 << 20  # Payload bytes kept per PES, the rest is only counted
+# Stream ids whose PES have no optional header (no PTS / DTS)
+PES_NO_HEADER = set([0xBC, 0xBE, 0xBF, 0xF0, 0xF1, 0xF2, 0xF8, 0xFF])
 crcPol = 0x04c11db7
 crcTable = []
 crcBigMask = 0xFFFFFFFF
@@ -17,16 +28,32 @@ for i in range(256):
         else:
             rev <<= 1
     crcTable.append(rev & crcBigMask)
+# Every byte with its bits in reverse order
+bitReverse = bytes(int("{:08b}".format(i)[::-1], 2) for i in range(256))
 
 
-def crc32(b):
-    """Ts custom crc"""
+def crc32_table(b):
+    """Ts custom crc, one byte at a time (reference implementation)"""
     value = crcBigMask
     for i in b:
         value = ((value << 8) ^ crcTable[(value >> 24) ^ i]) & crcBigMask
     return value
 
 
+def crc32(b):
+    """Ts custom crc
+    zlib computes the same polynomial with reflected bits, so reflecting
+    the input bytes and the result gives the MPEG-2 crc at C speed"""
+    value = zlib_crc32(bytes(b).translate(bitReverse)) ^ crcBigMask
+    return int.from_bytes(value.to_bytes(4, "little").translate(bitReverse),
+                          "big")
+
+
+def check_crc(section):
+    """True if the section (including its last 4 bytes crc) is valid"""
+    return not crc32(section)
+
+
 def try_decode(b):
     """Try to decode without throwing any error"""
     try:
@@ -51,12 +78,30 @@ def parse_bcd(b):
     return tuple(int(hex(b[i])[2:]) for i in range(3))
 
 
+def parse_seconds(b):
+    """3 bytes of BCD hours, minutes and seconds as seconds"""
+    hours, minutes, seconds = parse_bcd(b)
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def parse_utc(b):
+    """5 bytes of MJD and BCD hours, minutes and seconds as unix time"""
+    return ((b[0] << 8) + b[1] - MJD_TO_UNIX + 1) * DAY + parse_seconds(b[2:])
+
+
+def parse_timestamp(b):
+    """0123456701234567012345670123456701234567 (5 bytes, PTS / DTS)
+       ----***-***************-***************-"""
+    return (((b[0] & 0x0E) << 29) + (b[1] << 22) + ((b[2] & 0xFE) << 14) +
+            (b[3] << 7) + (b[4] >> 1))
+
+
 def parse_timestamp_2(b):
     """0123456701234567012345670123456701234567 (5 bytes)
        --***-***************-***************---"""
-    return (((b[0] & 0x38) << 30) + ((b[0] & 0x03) << 28) +
+    return (((b[0] & 0x38) << 27) + ((b[0] & 0x03) << 28) +
             (b[1] << 20) +
-            ((b[2] & 0xF8) << 15) + ((b[2] & 0x03) << 13) +
+            ((b[2] & 0xF8) << 12) + ((b[2] & 0x03) << 13) +
             (b[3] << 5) +
             ((b[4] & 0xF8) >> 3))
 
@@ -69,11 +114,20 @@ def parse_based_timestamp_2(b):
 
 
 def parse_pcr(b):
-    base = (b[0] << 25) + (b[1] << 17) + (b[2] << 11) + (b[3] << 3) + b[4] >> 5
+    """6 bytes. 33 bits of base, 6 reserved and 9 of extension"""
+    base = ((b[0] << 25) + (b[1] << 17) + (b[2] << 9) + (b[3] << 1) +
+            (b[4] >> 7))
     extension = ((b[4] & 0x01) << 8) + b[5]
     return base * 300 + extension
 
 
+def packet_pcr(packet):
+    """Return the PCR in the adaptation of packet or None if it has none"""
+    if packet[3] & 0x20 and packet[4] >= 7 and packet[5] & 0x10:
+        return parse_pcr(packet[6:12])
+    return None
+
+
 def parse_crc(b):
     """Parse a 32 bit CRC"""
     return (b[0] << 24) + (b[1] << 16) + (b[2] << 8) + b[3]
@@ -127,34 +181,358 @@ def parse_PMT(data):
     return pmt
 
 
+class Sections():
+    """Reassemble PSI sections from the payloads of many PIDs
+    Each PID fills a preallocated bytearray and a section is given as
+    soon as its section_length bytes are in, so several sections can
+    come out of one packet and none waits for the next PUSI"""
+    def __init__(self):
+        self.buffers = {}  # pid -> [buffer, bytes filled, section length]
+
+    def __contains__(self, pid):
+        return pid in self.buffers
+
+    def drop(self, pid):
+        """Forget the PID and any partial section it had"""
+        self.buffers.pop(pid, None)
+
+    def feed(self, pid, pusi, data):
+        """Add a packet payload of pid and return the completed sections"""
+        out = []
+        state = self.buffers.get(pid)
+        if pusi:
+            pointer = data[0]
+            if state is None:
+                state = self.buffers[pid] = [bytearray(SECTION_MAX), 0, 0]
+            elif state[1]:  # End of the previous section
+                self.fill(state, data[1:pointer + 1], out)
+            state[1] = state[2] = 0
+            data = data[pointer + 1:]
+        else:
+            if state is not None and state[1]:  # Middle of a section
+                self.fill(state, data, out)  # New ones only start with PUSI
+            return out
+        while data and data[0] != 0xFF:  # The rest is stuffing
+            data = self.fill(state, data, out)
+        return out
+
+    def fill(self, state, data, out):
+        """Copy data into the section of state, return what is left over
+        once the section is complete (appended to out)"""
+        buffer, filled, length = state
+        while data:
+            need = (length or 3) - filled
+            chunk = data[:need]
+            buffer[filled:filled + len(chunk)] = chunk
+            filled += len(chunk)
+            data = data[need:]
+            if not length and filled == 3:  # Header is in
+                length = ((buffer[1] & 0x0F) << 8) + buffer[2] + 3
+            if filled == length:
+                out.append(bytes(buffer[:length]))
+                filled = length = 0
+                break
+        state[1] = filled
+        state[2] = length
+        return data
+
+
+class SectionCache():
+    """Remember the PSI sections already seen to skip parsing repetitions
+    Sections are keyed on (pid, tableId, tableIdExtension, section) and
+    their (version, crc) tells if the content is still the same, a new
+    one replaces it so there is one entry per section however long it runs
+    A section is only stored once parsed, so one that could not be (a PMT
+    before its PAT) is parsed again when it repeats
+    onChange(pid, tableId, tableIdExtension, old, new) is called by
+    update() when a table shows up (old is None) or changes its version"""
+    def __init__(self, onChange=None):
+        self.sections = {}
+        self.versions = {}
+        self.onChange = onChange
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, pid, data):
+        """Return the key and the (version, crc bytes) of a whole section"""
+        length = ((data[1] & 0x0F) << 8) + data[2] + 3
+        return ((pid, data[0], (data[3] << 8) + data[4], data[6]),
+                ((data[5] & 0x3E) >> 1, bytes(data[length - 4:length])))
+
+    def hit(self, pid, data):
+        """True if the section in data is the same one stored before"""
+        if not (data[1] & 0x80 and len(data) >= 12):  # Not long form
+            return False
+        key, value = self.key(pid, data)
+        if self.sections.get(key) == value:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def store(self, pid, data):
+        """Remember a whole section whose crc was checked, once parsed"""
+        if not (data[1] & 0x80 and len(data) >= 12):
+            return
+        key, value = self.key(pid, data)
+        self.sections[key] = value
+
+    def update(self, pid, data):
+        """Follow the version of the table of a section whose crc was
+        checked, calling onChange when it is new or changes"""
+        if not (data[1] & 0x80 and len(data) >= 12):
+            return
+        key, (version, _) = self.key(pid, data)
+        table = key[:3]
+        old = self.versions.get(table)
+        if old != version:
+            self.versions[table] = version
+            if self.onChange is not None:
+                self.onChange(*table, old, version)
+
+    def clear(self):
+        self.sections.clear()
+        self.versions.clear()
+
+
+class Pes():
+    """Header of a PES packet and, if kept, its payload as the list of
+    views of the packets it came in (segments), joined only by payload()"""
+    def __init__(self, pid, streamId, length):
+        self.pid = pid
+        self.streamId = streamId
+        self.length = length  # PES_packet_length, 0 if unbounded (video)
+        self.pts = None
+        self.dts = None
+        self.escr = None
+        self.headerLength = 0  # Bytes before the payload
+        self.size = 0  # Payload bytes, kept or not
+        self.segments = []
+        self.truncated = False  # Some payload was not kept
+
+    def payload(self):
+        return b"".join(self.segments)
+
+
+def parse_PES_header(pid, data):
+    """Return the Pes started in data (payload of a PUSI packet)"""
+    streamId = data[3]
+    pes = Pes(pid, streamId, (data[4] << 8) + data[5])
+    if streamId in PES_NO_HEADER or len(data) < 9:
+        pes.headerLength = 6
+        return pes
+    flags = data[7]
+    pes.headerLength = 9 + data[8]
+    if pes.headerLength > len(data):  # Header cut by the packet: no times
+        return pes
+    offset = 9
+    if flags & 0x80:
+        pes.pts = parse_timestamp(data[9:14])
+        offset = 14
+        if flags & 0x40:
+            pes.dts = parse_timestamp(data[14:19])
+            offset = 19
+    if flags & 0x20:
+        pes.escr = parse_based_timestamp_2(data[offset:offset + 6])
+    return pes
+
+
+class PesAssembler():
+    """Reassemble the PES packets of many PIDs
+    A Pes is given once its PES_packet_length bytes are in or, if it is
+    unbounded, when the next one starts. Payloads are only kept (as
+    zero copy segments) with keepPayload, up to maxPayload bytes each"""
+    def __init__(self, keepPayload=False, maxPayload=PES_MAX):
+        self.keepPayload = keepPayload
+        self.maxPayload = maxPayload
+        self.pending = {}  # pid -> Pes
+        self.skip = {}  # pid -> header bytes still to come
+
+    def __contains__(self, pid):
+        return pid in self.pending
+
+    def drop(self, pid):
+        self.pending.pop(pid, None)
+
+    def feed(self, pid, pusi, data):
+        """Add a packet payload of pid and return the completed Pes
+        On a PUSI that is not a PES the PID is dropped"""
+        out = []
+        pending = self.pending
+        if pusi:
+            if pid in pending:
+                out.append(pending.pop(pid))
+            if not (data[0] | data[1] == 0 and data[2] == 1):
+                return out
+            pes = pending[pid] = parse_PES_header(pid, data)
+            self.skip[pid] = max(pes.headerLength - len(data), 0)
+            data = data[pes.headerLength:]
+        else:
+            pes = pending.get(pid)
+            if pes is None:
+                return out
+            if self.skip[pid]:  # Rest of a header cut by the packet
+                skip = self.skip[pid]
+                self.skip[pid] = max(skip - len(data), 0)
+                data = data[skip:]
+        size = pes.size + len(data)
+        if self.keepPayload:
+            if size <= self.maxPayload:
+                pes.segments.append(data)
+            else:
+                pes.truncated = True
+        pes.size = size
+        if pes.length and size + pes.headerLength - 6 >= pes.length:
+            del pending[pid]
+            out.append(pes)
+        return out
+
+    def flush(self):
+        """Give the Pes still waiting for the next PUSI"""
+        pending = self.pending
+        self.pending = {}
+        return list(pending.values())
+
+
+def open_blocks(kw):
+    """Return an iterator of raw blocks from the file / udp given in kw
+    Files can be memory mapped (mapped=True) and start at any packet, or
+    be followed as they grow (follow=True, see iotools.Follower) from any
+    byte (offset), the Follower is left in kw["follower"]
+    An udp source is left in kw["source"] to follow its counters"""
+    block = kw.pop("block", BLOCK)
+    start = kw.pop("start", 0)
+    mapped = kw.pop("mapped", False)
+    if "path" in kw and kw.pop("follow", False):
+        follower = iotools.Follower(kw["path"], kw.pop("offset", start * 188),
+                                    kw.pop("poll", iotools.POLL),
+                                    kw.pop("idle", None),
+                                    kw.pop("rotate", True))
+        kw["follower"] = follower
+        return follower.blocks(block * 188)
+    elif "path" in kw and mapped:
+        return iotools.MappedFile(kw["path"]).blocks(start, block)
+    elif "path" in kw:
+        read = iotools.read_file(kw["path"], start * 188)
+    elif "ip" in kw and "port" in kw:
+        source = iotools.UdpSource(kw["ip"], kw["port"],
+                                   kw.pop("rcvbuf", iotools.RCVBUF))
+        kw["source"] = source
+        return source.blocks()
+    else:
+        raise Exception(RFMT % "Not enough parameters given\n"
+                        "Give either a file path or an ip and a port")
+    return iotools.read_blocks(read, block * 188)
+
+
+class Sync():
+    """State and counters of the synchronization of a walk"""
+    def __init__(self, size=0):
+        self.size = size  # Packet size, 0 until detected
+        self.lost = 0  # Bytes skipped looking for sync
+        self.losses = 0  # Times the sync was lost
+        self.pending = 0  # Bytes read but not walked yet (a cut packet)
+        self.packets = 0  # Packets walked, skipped ones too
+
+    def __repr__(self):
+        return "Sync(size=%d, lost=%d, losses=%d)" % (self.size, self.lost,
+                                                       self.losses)
+
+
+def find_sync(data, start, sizes=SIZES):
+    """Look for SYNC_CHECKS sync bytes evenly spaced by any of sizes
+    Return (position, size), size is 0 if there is not enough data to
+    decide, in that case position is where the search should go on"""
+    window = bytes(data[start:])
+    find = window.find
+    length = len(window)
+    pos = find(b"\x47")
+    while pos != -1:
+        undecided = False
+        for size in sizes:
+            last = pos + size * (SYNC_CHECKS - 1)
+            if last >= length:
+                undecided = True
+            elif window[pos:last + 1:size] == SYNCS:
+                return (start + pos, size)
+        if undecided:
+            return (start + pos, 0)
+        pos = find(b"\x47", pos + 1)
+    return (start + length, 0)
+
+
+def walk(blocks, skipPids, sync=None):
+    """Yield every packet in blocks as a memoryview, skipping skipPids
+    The packet size (188, 192 or 204) is detected and on sync loss the
+    bytes are skipped until the sync is found again (counted in sync)
+    A block may end in the middle of a packet, the rest is carried over
+    (sync.pending bytes)"""
+    if sync is None:
+        sync = Sync()
+    rest = b""
+    size = sync.size
+    for data in blocks:
+        if rest:
+            data = rest + data
+        view = memoryview(data)
+        length = len(data)
+        i = 0
+        while True:
+            if not size:  # Look for sync
+                sizes = SIZES
+                if sync.size:  # Prefer the one we had
+                    sizes = (sync.size,) + SIZES
+                j, size = find_sync(view, i, sizes)
+                sync.lost += j - i
+                i = j
+                if not size:
+                    break
+                sync.size = size
+            stop = i + (length - i) // size * size
+            for j in range(i, stop, size):
+                if data[j] != 0x47:
+                    break
+                if ((data[j + 1] & 0x1F) << 8) + data[j + 2] in skipPids:
+                    continue
+                yield view[j:j + 188]
+            else:
+                sync.packets += (stop - i) // size
+                i = stop
+                break
+            sync.packets += (j - i) // size
+            i = j
+            size = 0
+            sync.losses += 1
+        rest = bytes(view[i:])
+        sync.pending = len(rest)
+    # The end of the stream may be too short to lock, trust single syncs
+    view = memoryview(rest)
+    size = sync.size or 188
+    used = 0
+    i = rest.find(b"\x47")
+    while i != -1 and len(rest) - i >= 188:
+        sync.packets += 1
+        if not ((rest[i + 1] & 0x1F) << 8) + rest[i + 2] in skipPids:
+            yield view[i:i + 188]
+        used += min(size, len(rest) - i)
+        i = rest.find(b"\x47", i + size)
+    sync.lost += len(rest) - used
+
+
 def loop(**kw):
-    """Loop the stream and yield packets"""
+    """Loop the stream and yield packets
+    Give a Sync() as sync to follow the synchronization counters and a
+    metrics.Metrics as metrics to time the reads and count the packets"""
     if "targetPids" in kw:
         skipPids = set(range(1 << 13)) - set(kw.pop("targetPids"))
     else:
         skipPids = set(kw.pop("skipPids", tuple()))
-    # Prepare the file / udp
-    if "path" in kw:
-        read = iotools.read_file(kw["path"])
-    elif "ip" in kw and "port" in kw:
-        read = iotools.read_udp(kw["ip"], kw["port"])
-    else:
-        Exception(RFMT % "Not enough parameters given\n"
-                  "Give either a file path or an ip and a port")
-    # Start loop
-    while True:
-        try:
-            sync = read(1)[0]
-        except IndexError:
-            break
-        if sync != 0x47:
-            raise Exception("Sync should be 0x47, it is 0x%x" % sync)
-        flagsAndPid = read(2)
-        pid = ((flagsAndPid[0] & 0x1F) << 8) + flagsAndPid[1]
-        if pid in skipPids:
-            read(185)
-            continue
-        yield b"\x47" + flagsAndPid + read(185)
+    sync = kw.pop("sync", None)
+    metrics = kw.pop("metrics", None)
+    if metrics is None:
+        return walk(open_blocks(kw), skipPids, sync)
+    blocks = metrics.timed_iter("read", open_blocks(kw))
+    return metrics.counted("packets", walk(blocks, skipPids, sync))
 
 
 def parsed_loop(**kw):
@@ -168,8 +546,9 @@ def parsed_loop(**kw):
 
 
 def store_PSI(**kw):
-    """Store and yield PSI data"""
-    packets = {}
+    """Store and yield PSI data, one whole section at a time"""
+    sections = Sections()
+    feed = sections.feed
     for pid, pusi, pF, aF, packet in parsed_loop(**kw):
         if not pF:
             continue
@@ -180,19 +559,12 @@ def store_PSI(**kw):
         data = packet[offset:]
         if pusi:
             if data[0] | data[1] == 0 and data[2] == 1:  # PES
+                sections.drop(pid)
                 continue
             elif (data[0] == 0x47 and data[1] | 0x80 == 0xE0 and
                   data[2] == 0x0F):  # DVB-MIP
                 continue
-            else:  # PSI
-                if pid in packets:
-                    yield packets[pid]
-                packets[pid] = data[data[0] + 1:]
-        else:
-            try:
-                packets[pid] += data
-            except KeyError:
-                pass  # Incomplete data does not match previous PID
+        yield from feed(pid, pusi, data)
 
 
 def filter_PES(**kw):
@@ -208,3 +580,19 @@ def filter_PES(**kw):
                 packet[offset + 2] == 1):  # Not PES
             continue
         yield packet
+
+
+def parse_PES(keepPayload=False, maxPayload=PES_MAX, **kw):
+    """Yield every Pes of the packets of loop(), see PesAssembler"""
+    assembler = PesAssembler(keepPayload, maxPayload)
+    feed = assembler.feed
+    for pid, pusi, pF, aF, packet in parsed_loop(**kw):
+        if not pF:
+            continue
+        offset = 4
+        if aF:  # Skip adaptation field
+            offset += 1 + packet[4]
+        if offset >= 188:
+            continue
+        yield from feed(pid, pusi, packet[offset:])
+    yield from assembler.flush()
@@ -0,0 +1,147 @@
+#! python3
+import iotools
+import tstools
+try:  # Optional, only needed by the vectorized parsing in this module
+    import numpy as np
+except ImportError:
+    np = None
+
+RFMT = "\033[1m\033[91m%s\033[0m"
+
+
+def need_numpy():
+    if np is None:
+        raise ImportError(RFMT % "numpy is needed for vectorized parsing")
+
+
+def as_array(block, size=188):
+    """View a block of whole packets as an (n, size) uint8 array (no copy)"""
+    need_numpy()
+    n = len(block) // size
+    return np.frombuffer(block, np.uint8, n * size).reshape(n, size)
+
+
+def headers(packets):
+    """Decode all the headers of an (n, 188) array at once
+    Return the arrays (pid, pusi, pF, aF, counter, tei)"""
+    b1 = packets[:, 1]
+    b3 = packets[:, 3]
+    pid = ((b1 & 0x1F).astype(np.uint16) << 8) | packets[:, 2]
+    pusi = (b1 & 0x40) >> 6
+    pF = (b3 & 0x10) >> 4
+    aF = (b3 & 0x20) >> 5
+    counter = b3 & 0x0F
+    tei = (b1 & 0x80) >> 7
+    return (pid, pusi, pF, aF, counter, tei)
+
+
+def pid_table(pids):
+    """Return an 8192 booleans lookup table with pids set"""
+    need_numpy()
+    table = np.zeros(1 << 13, bool)
+    table[list(pids)] = True
+    return table
+
+
+def pid_index(pid, offset=0):
+    """Group the packet indexes of a pid array by PID
+    Return a dict {pid: array of indexes}, indexes start at offset"""
+    order = np.argsort(pid, kind="stable")
+    sortedPid = pid[order]
+    pids, starts = np.unique(sortedPid, return_index=True)
+    groups = np.split(order + offset, starts[1:])
+    return dict(zip(pids.tolist(), groups))
+
+
+def aligned(blocks, sync=None):
+    """Yield (n, 188) arrays from blocks, carrying over partial packets
+    A block out of sync is cut where the sync byte is wrong and goes on
+    where tstools.find_sync locks again, the bytes skipped are counted in
+    sync (a tstools.Sync) like tstools.walk does"""
+    if sync is None:
+        sync = tstools.Sync(188)
+    rest = b""
+    for data in blocks:
+        if rest:
+            data = rest + data
+        view = memoryview(data)
+        i = 0
+        while True:
+            end = i + (len(data) - i) // 188 * 188
+            if end == i:
+                break
+            packets = as_array(view[i:end])
+            bad = np.flatnonzero(packets[:, 0] != 0x47)
+            if not len(bad):
+                sync.packets += len(packets)
+                yield packets
+                i = end
+                break
+            good = int(bad[0])
+            if good:
+                sync.packets += good
+                yield packets[:good]
+            j = i + good * 188
+            i, found = tstools.find_sync(view, j, (188,))
+            sync.lost += i - j
+            sync.losses += 1
+            if not found:  # Decided with the next block
+                break
+        rest = bytes(view[i:])
+        sync.pending = len(rest)
+
+
+def index_blocks(blocks, sync=None):
+    """Build a {pid: array of packet indexes} index over all the blocks
+    (indexes of the packets in sync, skipped bytes are not counted)"""
+    groups = {}
+    offset = 0
+    for packets in aligned(blocks, sync):
+        pid = headers(packets)[0]
+        for p, indexes in pid_index(pid, offset).items():
+            groups.setdefault(p, []).append(indexes)
+        offset += len(packets)
+    return dict((p, np.concatenate(i)) for p, i in groups.items())
+
+
+def index_file(path, **kw):
+    """Index every PID of the ts file at path (memory mapped)"""
+    return index_blocks(iotools.MappedFile(path).blocks(**kw))
+
+
+def select(blocks, pids, sync=None):
+    """Yield, per block, the packets of pids joined as one bytes object"""
+    table = pid_table(pids)
+    for packets in aligned(blocks, sync):
+        mask = table[headers(packets)[0]]
+        if mask.all():
+            yield packets.tobytes()
+        elif mask.any():
+            yield packets[mask].tobytes()
+
+
+def runs(block, table, size=188):
+    """Return the (start, stop) byte ranges of the runs of packets of a
+    block of whole packets whose PID is set in table (see pid_table)
+    size is 188, 192 or 204 (records start with their tstools.PREFIXES)"""
+    packets = as_array(block, size)
+    p = tstools.PREFIXES[size]
+    pid = (((packets[:, p + 1] & 0x1F).astype(np.uint16) << 8) |
+           packets[:, p + 2])
+    mask = np.concatenate(([False], table[pid], [False]))
+    edges = (np.flatnonzero(mask[1:] != mask[:-1]) * size).tolist()
+    return list(zip(edges[::2], edges[1::2]))
+
+
+def loop(**kw):
+    """Like tstools.loop() but selecting the PIDs with array masking
+    Yield memoryviews of the packets of targetPids (or not in skipPids)"""
+    if "targetPids" in kw:
+        pids = set(kw.pop("targetPids"))
+    else:
+        pids = set(range(1 << 13)) - set(kw.pop("skipPids", tuple()))
+    sync = kw.pop("sync", None)
+    for data in select(tstools.open_blocks(kw), pids, sync):
+        view = memoryview(data)
+        for i in range(0, len(data), 188):
+            yield view[i:i + 188]